@@ -0,0 +1,407 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import idlemaster
+
+
+PROFILE_NAME = "76561197960287930"
+
+BADGES_PER_PAGE = 150
+
+# an idler which tells the server the game is being idled
+# and waits to be terminated, the server URL is its first argument
+IDLER_STUB = ("import sys, time, urllib.request\n"
+              "app_id = sys.stdin.readline().strip() if '--worker' in sys.argv else sys.argv[-1]\n"
+              "if not app_id: sys.exit()\n"
+              "urllib.request.urlopen(sys.argv[1] + '/idle/' + app_id).read()\n"
+              "print('ready', flush=True)\n"
+              "time.sleep(10 ** 6)\n")
+
+_AVATAR_HTML = ('<div class="user_avatar_block">'
+                '<a class="user_avatar playerAvatar online" href="/profiles/{0}">'
+                '<img src="avatar.jpg"></a></div>').format(PROFILE_NAME)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients drop connections on purpose, e.g. after reading a part of a page
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+def _generate_account(badges_count, seed):
+    rnd = random.Random(seed)
+
+    badges = []
+    for i in range(badges_count):
+        is_game = rnd.random() < 0.9
+        badges.append({
+            "id": 10 * (i + 1) if is_game else -1,
+            "title": "Game {0}".format(i + 1) if is_game else "Community Badge {0}".format(i + 1),
+            "card_drops_remaining": rnd.choice([0, 0, 0, 1, 2, 3]) if is_game else None,
+            "playtime": rnd.choice([0, 0.5, 1.2, 3.4, 17.9]),
+            "cards_collected": rnd.randint(0, 6),
+            "cards_total": 6,
+        })
+
+    return badges
+
+
+def _render_badge_row(badge, card_drops_remaining):
+    if badge["id"] == -1:
+        link = "/profiles/{0}/badges/2".format(PROFILE_NAME)
+        stats = ""
+    else:
+        link = "https://steamcommunity.com/profiles/{0}/gamecards/{1}/".format(
+            PROFILE_NAME, badge["id"])
+        if card_drops_remaining:
+            drops = "{0} card drops remaining".format(card_drops_remaining)
+        else:
+            drops = "No card drops remaining"
+        playtime = "{0} hrs on record".format(badge["playtime"]) if badge["playtime"] else "&nbsp;"
+        stats = ('<div class="badge_title_stats">'
+                 '<div class="badge_title_stats_drops">'
+                 '<span class="progress_info_bold">{0}</span></div>'
+                 '<div class="badge_title_stats_playtime">{1}</div></div>').format(drops, playtime)
+
+    return ('<div class="badge_row is_link">'
+            '<a class="badge_row_overlay" href="{0}"></a>'
+            '<div class="badge_row_inner">{1}'
+            '<div class="badge_title_row"><div class="badge_title">{2}&nbsp;'
+            '<span class="badge_view_details">View details</span></div></div>'
+            '<div class="badge_content"><div class="badge_progress_info">'
+            '{3} of {4} cards collected</div></div>'
+            '</div></div>').format(link, stats, badge["title"],
+                                   badge["cards_collected"], badge["cards_total"])
+
+
+def _render_badges_page(badges, page_number, padding, get_card_drops_remaining):
+    pages_count = max(1, (len(badges) + BADGES_PER_PAGE - 1) // BADGES_PER_PAGE)
+    rows = badges[(page_number - 1) * BADGES_PER_PAGE:page_number * BADGES_PER_PAGE]
+
+    # like Steam, only a few page links and the last one are shown
+    links = "".join('<a class="pagelink" href="?p={0}">{0}</a>'.format(n)
+                    for n in sorted(set(list(range(2, min(pages_count, 4) + 1)) +
+                                        ([pages_count] if pages_count > 1 else []))))
+
+    return ('<html><head><title>Badges</title></head><body>{0}{1}'
+            '<div class="badges_sheet">{2}</div>'
+            '<div class="pageLinks">{3}</div></body></html>').format(
+                _AVATAR_HTML, "<!-- " + "x" * padding + " -->", "".join(
+                    _render_badge_row(badge, get_card_drops_remaining(badge["id"]))
+                    for badge in rows), links)
+
+
+def _render_gamecards_page(card_drops_remaining, padding):
+    if card_drops_remaining:
+        drops = "{0} card drops remaining".format(card_drops_remaining)
+    else:
+        drops = "No card drops remaining"
+
+    return ('<html><head><title>Cards</title></head><body>{0}'
+            '<div class="badge_title_stats_drops">'
+            '<span class="progress_info_bold">{1}</span></div>{2}</body></html>').format(
+                _AVATAR_HTML, drops,
+                '<div class="badge_card_set_card">{0}</div>'.format("x" * padding))
+
+
+def _create_server(badges, options):
+    rnd = random.Random(options.seed)
+    drops_start_times = {}
+    requests_count = [0]
+    lock = threading.Lock()
+
+    badges_by_id = dict((badge["id"], badge) for badge in badges if badge["id"] != -1)
+
+    def get_card_drops_remaining(game_id):
+        badge = badges_by_id.get(game_id)
+        if badge is None:
+            return 0
+
+        # drops come over time since the game was started being idled
+        with lock:
+            start_time = drops_start_times.get(game_id)
+        if start_time is None:
+            return badge["card_drops_remaining"]
+        dropped = int((time.time() - start_time) / options.drop_interval * options.time_scale)
+        return max(0, badge["card_drops_remaining"] - dropped)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = [part for part in url.path.split("/") if part]
+
+            # requests of idlers aren't counted
+            if len(parts) == 2 and parts[0] == "idle":
+                with lock:
+                    drops_start_times.setdefault(int(parts[1]), time.time())
+                self._reply(200, "")
+                return
+
+            with lock:
+                requests_count[0] += 1
+                roll = rnd.random()
+
+            if options.latency:
+                time.sleep(options.latency)
+
+            if roll < options.throttle_rate:
+                self._reply(429, "Too Many Requests", headers={"Retry-After": "1"})
+                return
+            if roll < options.throttle_rate + options.error_rate:
+                self._reply(500, "Internal Server Error")
+                return
+
+            if len(parts) >= 3 and parts[2] == "badges":
+                page_number = int(query.get("p", ["1"])[0])
+                self._reply(200, _render_badges_page(badges, page_number, options.padding,
+                                                     get_card_drops_remaining))
+            elif len(parts) >= 4 and parts[2] == "gamecards":
+                self._reply(200, _render_gamecards_page(
+                    get_card_drops_remaining(int(parts[3])), options.padding))
+            elif parts[-1:] == ["appdetails"]:
+                app_id = query["appids"][0]
+                badge = badges_by_id.get(int(app_id))
+                data = {app_id: {"success": badge is not None}}
+                if badge is not None:
+                    data[app_id]["data"] = {"name": badge["title"]}
+                self._reply(200, json.dumps(data), "application/json")
+            elif parts[-1:] == ["average_card_price"]:
+                app_id = int(query["appid"][0])
+                self._reply(200, "{0:.2f}".format((app_id % 97) / 10.0))
+            else:
+                self._reply(404, "Not Found")
+
+        def _reply(self, status, body, content_type="text/html", headers=None):
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests_count = requests_count
+
+    thread = threading.Thread(target=server.serve_forever, name="stand-in-server")
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def _get_http_stats():
+    count = 0
+    total = 0
+    for metric in idlemaster._get_metrics_snapshot():
+        if metric["name"] == "http_request_seconds":
+            count += metric["count"]
+            total += metric["sum"]
+
+    return count, total
+
+
+def _run_stage(name, server, function, items_name=None):
+    idlemaster._metrics.clear()
+    requests_before = server.requests_count[0]
+
+    tracemalloc.start()
+    start_time = time.time()
+    result = function()
+    elapsed = time.time() - start_time
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    http_count, http_total = _get_http_stats()
+
+    report = {
+        "stage": name,
+        "seconds": round(elapsed, 3),
+        "server_requests": server.requests_count[0] - requests_before,
+        "avg_latency_ms": round(1000 * http_total / http_count, 2) if http_count else None,
+        "peak_memory_mb": round(peak_memory / 1024.0 / 1024.0, 2),
+    }
+    if items_name:
+        report[items_name] = len(result)
+        report[items_name + "_per_second"] = round(len(result) / elapsed, 1) if elapsed else None
+
+    return result, report
+
+
+def _accelerated_poll_policy(time_scale):
+    def policy(state, history, erroneous_state):
+        return idlemaster._fixed_poll_delay(state, history, erroneous_state) / time_scale
+
+    return policy
+
+
+def run_benchmark(options):
+    badges = _generate_account(options.badges, options.seed)
+    server = _create_server(badges, options)
+    base_url = "http://127.0.0.1:{0}".format(server.server_port)
+
+    idlemaster._settings.update({
+        "steam_community_url": base_url,
+        "steam_store_url": base_url,
+        "average_card_price_url": base_url,
+        "rate_limits": {"*": [options.rate_limit, options.rate_limit]},
+        "badge_pages_concurrency": options.concurrency,
+        "idle_slots": options.slots,
+        "idler_command": [sys.executable, "-c", IDLER_STUB, base_url],
+        "poll_policy": "benchmark",
+        "poll_min_delay": 60.0 / options.time_scale,
+        "drop_timeout": 5 * 60 * 60.0 / options.time_scale,
+        "http_backoff_factor": 0.1,
+        "metrics_file": None,
+    })
+    idlemaster.register_poll_policy("benchmark", _accelerated_poll_policy(options.time_scale))
+
+    session = idlemaster._create_session({"steamLoginSecure": PROFILE_NAME})
+
+    reports = []
+
+    badges_info, report = _run_stage(
+        "gather_badges_info", server,
+        lambda: idlemaster._gather_badges_info(PROFILE_NAME, session), "badges")
+    reports.append(report)
+
+    _, report = _run_stage(
+        "save_badges_info_streamed", server,
+        lambda: idlemaster._save_badges_info(
+            idlemaster._iter_badges_info(PROFILE_NAME, session), "badges.json"))
+    reports.append(report)
+
+    _, report = _run_stage(
+        "store_badges_info", server,
+        lambda: idlemaster._store_badges_info(
+            PROFILE_NAME, idlemaster._iter_badges_info(PROFILE_NAME, session), replace=True))
+    reports.append(report)
+
+    idle_list, report = _run_stage(
+        "generate_idle_list", server,
+        lambda: idlemaster._generate_idle_list(badges_info, sort=options.sort,
+                                               profile_name=PROFILE_NAME), "games")
+    reports.append(report)
+
+    _, report = _run_stage(
+        "generate_idle_list_by_price", server,
+        lambda: idlemaster._generate_idle_list(
+            badges_info, sort=idlemaster.SORT_MOST_AVERAGE_CARD_PRICE), "games")
+    reports.append(report)
+
+    _, report = _run_stage(
+        "query_idle_list", server,
+        lambda: idlemaster._query_idle_list(PROFILE_NAME), "games")
+    reports.append(report)
+
+    _, report = _run_stage(
+        "query_idle_list_by_price", server,
+        lambda: idlemaster._query_idle_list(
+            PROFILE_NAME, sort=idlemaster.SORT_MOST_AVERAGE_CARD_PRICE), "games")
+    reports.append(report)
+
+    idle_list = idle_list[:options.idle_games]
+    drops = sum(badge["card_drops_remaining"] for badge in badges if badge["id"] in idle_list)
+
+    _, report = _run_stage(
+        "idle", server,
+        lambda: idlemaster._idle(list(idle_list), PROFILE_NAME, session))
+    report["games"] = len(idle_list)
+    report["card_drops"] = drops
+    report["simulated_hours"] = round(report["seconds"] * options.time_scale / 3600.0, 2)
+    report["cards_per_simulated_hour"] = \
+        round(drops / report["simulated_hours"], 2) if report["simulated_hours"] else None
+    reports.append(report)
+
+    idlemaster._shutdown_idler_pool()
+    idlemaster._close_db()
+    server.shutdown()
+
+    for report in reports:
+        logging.warning(json.dumps(report))
+
+    return reports
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark idle master against a local Steam stand-in server")
+    parser.add_argument("--badges", type=int, default=1000,
+                        help="number of badges on the account (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="server latency in seconds (default: %(default)s)")
+    parser.add_argument("--padding", type=int, default=50000,
+                        help="filler bytes added to every page (default: %(default)s)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 500 (default: %(default)s)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 429 (default: %(default)s)")
+    parser.add_argument("--rate-limit", type=float, default=1000,
+                        help="client rate limit in requests per second (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="badges pages requested at a time (default: %(default)s)")
+    parser.add_argument("--idle-games", type=int, default=5,
+                        help="number of games idled (default: %(default)s)")
+    parser.add_argument("--slots", type=int, default=1,
+                        help="number of games idled at a time (default: %(default)s)")
+    parser.add_argument("--sort", choices=[
+        idlemaster.SORT_MOST_REMAINING_DROPS, idlemaster.SORT_LEAST_REMAINING_DROPS,
+        idlemaster.SORT_MOST_AVERAGE_CARD_PRICE, idlemaster.SORT_LEAST_AVERAGE_CARD_PRICE,
+        idlemaster.SORT_MOST_CARDS_PER_HOUR, idlemaster.SORT_MOST_VALUE_PER_HOUR],
+                        help="sort method of the idled list (default: badges order)")
+    parser.add_argument("--drop-interval", type=float, default=30 * 60,
+                        help="simulated seconds between drops (default: %(default)s)")
+    parser.add_argument("--time-scale", type=float, default=3600,
+                        help="simulated seconds per real second while idling "
+                             "(default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: %(default)s)")
+    parser.add_argument("--output", help="file to write the JSON report to")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = _parse_args(argv)
+
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+
+    # caches and histories are written to the working directory,
+    # so the benchmark runs in an empty one
+    working_directory = tempfile.mkdtemp(prefix="idle_master_benchmark_")
+    previous_directory = os.getcwd()
+    os.chdir(working_directory)
+    try:
+        reports = run_benchmark(options)
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(working_directory, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(reports, f, indent=4)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
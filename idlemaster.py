@@ -1,18 +1,37 @@
 
 from operator import itemgetter
 import time
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import json
 import sys
 import subprocess
 import logging
+import logging.handlers
+import queue
 import os
+import atexit
+import cProfile
+from contextlib import contextmanager
+import re
+import codecs
+from collections import deque
+import threading
+import sqlite3
+import asyncio
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 
-
-_input = vars(__builtins__).get("raw_input", input)
+try:
+    import lxml  # noqa: F401
+    _DEFAULT_HTML_PARSER = "lxml"
+except ImportError:
+    _DEFAULT_HTML_PARSER = "html.parser"
 
 
 FILTER_NOT_ONLY_GAMES = "not_only_games"
@@ -22,450 +41,2343 @@ SORT_MOST_REMAINING_DROPS = "most_remaining_drops"
 SORT_LEAST_REMAINING_DROPS = "least_remaining_drops"
 SORT_MOST_AVERAGE_CARD_PRICE = "most_avg_card_price"
 SORT_LEAST_AVERAGE_CARD_PRICE = "least_avg_card_price"
+SORT_MOST_CARDS_PER_HOUR = "most_cards_per_hour"
+SORT_MOST_VALUE_PER_HOUR = "most_value_per_hour"
+
+GAME_NAMES_TABLE = "game_names"
+AVERAGE_CARD_PRICES_TABLE = "average_card_prices"
+BADGES_DIFF_FILENAME = "badges_diff.json"
+
+# printed by an idler once it is actually idling
+IDLER_READY_LINE = "ready"
+
+POLL_POLICY_FIXED = "fixed"
+POLL_POLICY_ADAPTIVE = "adaptive"
+
+# drop intervals of a game needed to prefer them to the ones of all the games
+_MIN_GAME_DROP_INTERVALS = 3
+
+DEFAULT_SETTINGS = {
+    "steam_community_url": "https://steamcommunity.com",
+    "steam_store_url": "https://store.steampowered.com",
+    "average_card_price_url": "http://api.enhancedsteam.com",
+    "http_connect_timeout": 10,
+    "http_read_timeout": 30,
+    "http_retries": 3,
+    "http_backoff_factor": 2,
+    "http_pool_size": 10,
+    "badge_pages_concurrency": 4,
+    "html_parser": _DEFAULT_HTML_PARSER,
+    "badge_page_probe": True,
+    "batch_drop_checks": True,
+    "batch_drop_checks_sort": None,
+    "state_db": "idle_master.db",
+    "store_api_concurrency": 4,
+    "game_names_cache_ttl": 30 * 24 * 60 * 60,
+    "price_api_concurrency": 4,
+    "average_card_prices_cache_ttl": 24 * 60 * 60,
+    "default_average_card_price": 0.0,
+    "idle_slots": 1,
+    "priming_slots": 0,
+    "priming_playtime": 2.0,
+    "idler_pool_size": 1,
+    "idler_command": None,
+    "idler_headless": False,
+    "idler_ready_timeout": 30,
+    "idler_restart_delay": 5,
+    "idler_restart_max_delay": 5 * 60,
+    "idler_stop_timeout": 10,
+    "poll_policy": POLL_POLICY_ADAPTIVE,
+    "poll_min_delay": 60,
+    "poll_max_delay": 20 * 60,
+    "poll_margin": 60,
+    "drop_timeout": 5 * 60 * 60,
+    "error_suspend_timeout": 5 * 60,
+    "error_quit_timeout": 24 * 60 * 60,
+    "drop_history_size": 50,
+    "default_drop_interval": 30 * 60,
+    "command_socket": None,
+    "journal_file": "idle_journal_{profile}.jsonl",
+    "metrics_file": "metrics.json",
+    "log_file": "idle_master.log",
+    "log_level": "DEBUG",
+    "log_max_bytes": 10 * 1024 * 1024,
+    "log_backup_count": 5,
+    "log_rotate_when": None,
+    "log_json_file": None,
+    "prometheus_textfile": None,
+    "profile_directory": None,
+    # requests per second and burst size for each host, "*" is for other hosts
+    "rate_limits": {
+        "steamcommunity.com": [1, 10],
+        "store.steampowered.com": [0.5, 10],
+        "api.enhancedsteam.com": [2, 5],
+        "*": [2, 5],
+    },
+}
+
+_settings = dict(DEFAULT_SETTINGS)
+
+_http_adapter = None
+_anonymous_session = None
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_metrics_start_time = time.time()
+_metrics_logger = logging.getLogger("idle_master.metrics")
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+_db = None
+_db_lock = threading.RLock()
+
+# idler processes waiting for a game, by idler command line
+_idler_pools = {}
+
+
+def _class_strainer(*classes):
+    classes = set(classes)
+
+    # depending on the parser the class attribute
+    # may not be split into separate classes at this point
+    def match(value):
+        if value is None:
+            return False
+        if not isinstance(value, list):
+            value = value.split()
+        return not classes.isdisjoint(value)
+
+    return SoupStrainer(attrs={"class": match})
+
+
+# only the parts of the pages that are actually used get parsed into trees
+_BADGES_PAGE_STRAINER = _class_strainer("badge_row", "pagelink", "user_avatar")
+_BADGE_PAGE_STRAINER = _class_strainer("progress_info_bold", "user_avatar")
+
+_PROGRESS_INFO_RE = re.compile(
+    r'<span class="progress_info_bold">\s*([^<]*?)\s*</span>')
+_USER_AVATAR_RE = re.compile(
+    r'<a\s[^>]*class="(?:[^"]*\s)?user_avatar[\s"]')
+
+_BADGE_ROW_OVERLAY_RE = re.compile(r'<a\s[^>]*class="badge_row_overlay"[^>]*>')
+_GAMECARDS_LINK_RE = re.compile(r'href="[^"]*/gamecards/(\d+)')
+
+_BADGE_PAGE_PROBE_CHUNK_SIZE = 8 * 1024
+# markers split between chunks are found by searching a bit of the previous chunk again
+_BADGE_PAGE_PROBE_OVERLAP = 512
+
+_STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS badges (
+    profile TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    is_game INTEGER NOT NULL,
+    page INTEGER,
+    has_stats INTEGER NOT NULL,
+    card_drops_remaining INTEGER,
+    playtime REAL,
+    cards_collected INTEGER,
+    cards_total INTEGER,
+    badge_ready INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (profile, id, title)
+);
+CREATE INDEX IF NOT EXISTS badges_card_drops_remaining
+    ON badges (profile, card_drops_remaining);
+CREATE INDEX IF NOT EXISTS badges_playtime ON badges (profile, playtime);
+CREATE INDEX IF NOT EXISTS badges_is_game ON badges (profile, is_game);
+
+CREATE TABLE IF NOT EXISTS game_names (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL,
+    time REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS average_card_prices (
+    id INTEGER PRIMARY KEY,
+    value REAL NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS average_card_prices_value ON average_card_prices (value);
+
+CREATE TABLE IF NOT EXISTS drop_events (
+    profile TEXT NOT NULL,
+    game_id INTEGER NOT NULL,
+    time REAL NOT NULL,
+    drop_interval REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS drop_events_profile ON drop_events (profile);
+
+CREATE TABLE IF NOT EXISTS idle_history (
+    profile TEXT NOT NULL,
+    game_id INTEGER NOT NULL,
+    time REAL NOT NULL,
+    result TEXT NOT NULL,
+    idle_time REAL NOT NULL,
+    dead_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idle_history_profile_time ON idle_history (profile, time);
+"""
 
 
 class NotAuthorizedException(Exception):
     pass
 
 
+class TooManyRequestsException(Exception):
+    def __init__(self, message, retry_after):
+        super(TooManyRequestsException, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class BadgeInfo(object):
+    __slots__ = ("id", "title", "is_game", "page", "has_stats", "card_drops_remaining",
+                 "playtime", "cards_collected", "cards_total", "badge_ready")
+
+    def __init__(self, id=-1, title="", is_game=False, page=None, has_stats=False,
+                 card_drops_remaining=None, playtime=None, cards_collected=None,
+                 cards_total=None, badge_ready=False):
+        self.id = id
+        self.title = title
+        self.is_game = is_game
+        self.page = page
+        # card_drops_remaining and playtime are None if the badge has no stats
+        self.has_stats = has_stats
+        self.card_drops_remaining = card_drops_remaining
+        self.playtime = playtime
+        self.cards_collected = cards_collected
+        self.cards_total = cards_total
+        self.badge_ready = badge_ready
+
+    def __eq__(self, other):
+        return isinstance(other, BadgeInfo) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "BadgeInfo({0})".format(", ".join(
+            "{0}={1!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+    def to_dict(self):
+        data = {
+            "id": self.id,
+            "title": self.title,
+            "is_game": self.is_game,
+        }
+        if self.page is not None:
+            data["page"] = self.page
+        if self.has_stats:
+            data["card_drops_remaining"] = self.card_drops_remaining
+            data["playtime"] = self.playtime
+        else:
+            data["no_stats"] = True
+        data["cards_collected"] = self.cards_collected
+        data["cards_total"] = self.cards_total
+        data["badge_ready"] = self.badge_ready
+
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        # older snapshots have card numbers as strings
+        cards_collected = data.get("cards_collected")
+        cards_total = data.get("cards_total")
+
+        return cls(
+            id=data["id"],
+            title=data["title"],
+            is_game=data["is_game"],
+            page=data.get("page"),
+            has_stats=not data.get("no_stats", False),
+            card_drops_remaining=data.get("card_drops_remaining"),
+            playtime=data.get("playtime"),
+            cards_collected=int(cards_collected) if cards_collected is not None else None,
+            cards_total=int(cards_total) if cards_total is not None else None,
+            badge_ready=data.get("badge_ready", False)
+        )
+
+
 def _set_working_directory():
     os.chdir(os.path.abspath(os.path.dirname(sys.argv[0])))
 
 
+class _JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        # metrics are logged as their summary entries, so both kinds of lines are alike
+        entry = getattr(record, "metric", None)
+        if entry is None:
+            entry = {"kind": "log", "name": record.name, "labels": {"level": record.levelname},
+                     "message": record.getMessage()}
+
+        return json.dumps(dict(entry, time=record.created))
+
+
+def _is_log_record(record):
+    return not hasattr(record, "metric")
+
+
+def _create_log_file_handler(filename):
+    if _settings["log_rotate_when"]:
+        return logging.handlers.TimedRotatingFileHandler(
+            filename, when=_settings["log_rotate_when"],
+            backupCount=_settings["log_backup_count"], encoding="utf-8")
+
+    return logging.handlers.RotatingFileHandler(
+        filename, maxBytes=_settings["log_max_bytes"],
+        backupCount=_settings["log_backup_count"], encoding="utf-8")
+
+
 def _set_up_logging():
     date_format = "%Y-%m-%d %H:%M:%S"
     message_format = "%(asctime)s - %(levelname)s - %(message)s"
+    formatter = logging.Formatter(message_format, date_format)
 
-    logging.basicConfig(
-        filename="idle_master.log", format=message_format,
-        datefmt=date_format, level=logging.DEBUG)
+    handlers = []
+    if _settings["log_file"]:
+        fh = _create_log_file_handler(_settings["log_file"])
+        fh.setLevel(_settings["log_level"])
+        handlers.append(fh)
 
     ch = logging.StreamHandler(sys.stdout)
     ch.setLevel(logging.INFO)
-    ch.setFormatter(logging.Formatter(message_format, date_format))
+    handlers.append(ch)
+
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(_is_log_record)
+
+    if _settings["log_json_file"]:
+        jh = _create_log_file_handler(_settings["log_json_file"])
+        jh.setLevel(_settings["log_level"])
+        jh.setFormatter(_JsonLinesFormatter())
+        handlers.append(jh)
+
+    # records are written by a background thread, so a slow disk doesn't hold up idling
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
-    logging.getLogger("").addHandler(ch)
+    root_logger = logging.getLogger("")
+    root_logger.setLevel(min(handler.level for handler in handlers))
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def _load_settings(filename="config.json"):
+    if not os.path.isfile(filename):
+        return
+
+    with open(filename) as f:
+        config = json.load(f)
+
+    settings = config.get("settings") or {}
+    for key in settings:
+        if key not in DEFAULT_SETTINGS:
+            raise Exception('Unknown setting "{0}"'.format(key))
+
+    _settings.update(settings)
 
 
 def _init():
     _set_working_directory()
+    _load_settings()
     _set_up_logging()
 
+    atexit.register(_close_db)
+    if _settings["metrics_file"]:
+        atexit.register(_write_metrics_summary, _settings["metrics_file"])
+    if _settings["log_json_file"]:
+        atexit.register(_log_metrics)
+    if _settings["prometheus_textfile"]:
+        atexit.register(_write_prometheus_textfile, _settings["prometheus_textfile"])
+
+
+def _get_metric(kind, name, labels):
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        metric = {"kind": kind, "name": name, "labels": labels,
+                  "count": 0, "sum": 0, "max": 0}
+        _metrics[key] = metric
+
+    return metric
+
+
+def _increment(name, value=1, **labels):
+    with _metrics_lock:
+        _get_metric("counter", name, labels)["sum"] += value
+
+
+def _observe(name, value, **labels):
+    with _metrics_lock:
+        metric = _get_metric("summary", name, labels)
+        metric["count"] += 1
+        metric["sum"] += value
+        metric["max"] = max(metric["max"], value)
+
+
+@contextmanager
+def _timed(name, **labels):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        _observe(name, time.time() - start_time, **labels)
+
+
+def _get_metrics_snapshot():
+    with _metrics_lock:
+        return [dict(metric) for metric in _metrics.values()]
+
+
+def _write_file_atomically(filename, content):
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+
+def _get_metric_entry(metric):
+    entry = {"kind": metric["kind"], "name": metric["name"], "labels": metric["labels"],
+             "sum": metric["sum"]}
+    if metric["kind"] == "summary":
+        entry["count"] = metric["count"]
+        entry["max"] = metric["max"]
+
+    return entry
+
+
+def _write_metrics_summary(filename):
+    metrics = [_get_metric_entry(metric)
+               for metric in sorted(_get_metrics_snapshot(), key=itemgetter("name"))]
+
+    _write_file_atomically(filename, json.dumps({
+        "start_time": _metrics_start_time,
+        "end_time": time.time(),
+        "metrics": metrics,
+    }, indent=4))
+
+
+def _log_metrics():
+    if not _settings["log_json_file"]:
+        return
+
+    for metric in sorted(_get_metrics_snapshot(), key=itemgetter("name")):
+        _metrics_logger.info("%s", metric["name"], extra={"metric": _get_metric_entry(metric)})
+
+
+def _format_prometheus_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(
+        '{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in sorted(labels.items())) + "}"
+
+
+def _write_prometheus_textfile(filename):
+    lines = []
+    written_types = set()
+    for metric in sorted(_get_metrics_snapshot(), key=itemgetter("name")):
+        name = "idle_master_" + metric["name"]
+        labels = _format_prometheus_labels(metric["labels"])
+
+        if name not in written_types:
+            lines.append("# TYPE {0} {1}".format(name, metric["kind"]))
+            written_types.add(name)
+
+        if metric["kind"] == "summary":
+            lines.append("{0}_count{1} {2}".format(name, labels, metric["count"]))
+            lines.append("{0}_sum{1} {2}".format(name, labels, metric["sum"]))
+        else:
+            lines.append("{0}{1} {2}".format(name, labels, metric["sum"]))
+
+    _write_file_atomically(filename, "\n".join(lines) + "\n")
+
+
+def _parse_auth_data(cookies):
+    if cookies is None:
+        raise Exception('Incorrect config file: no "cookies" section')
+
+    if not cookies.get("steamRememberLogin") and not cookies.get("steamLoginSecure"):
+        raise Exception("Neither steamRememberLogin nor steamLoginSecure is set")
+
+    return {
+        "cookies": cookies,
+        "profile_name": (cookies.get("steamRememberLogin") or
+                         cookies["steamLoginSecure"])[:17]
+    }
+
+
+def _get_auth_data(filename="config.json"):
+    with open(filename) as f:
+        config = json.load(f)
+
+    return _parse_auth_data(config.get("cookies"))
+
+
+def _get_accounts_data(filename="config.json"):
+    with open(filename) as f:
+        config = json.load(f)
+
+    accounts = config.get("accounts")
+    if not accounts:
+        raise Exception('Incorrect config file: no "accounts" section')
+
+    accounts_data = []
+    for account in accounts:
+        auth_data = _parse_auth_data(account.get("cookies"))
+        name = account.get("name") or auth_data["profile_name"]
+        if name in [account_data["name"] for account_data in accounts_data]:
+            raise Exception('Incorrect config file: duplicate account name "{0}"'.format(name))
+
+        auth_data["name"] = name
+        auth_data["idle_list"] = account.get("idle_list") or "idle_list_{0}.txt".format(name)
+        auth_data["idler_command"] = account.get("idler_command")
+        accounts_data.append(auth_data)
+
+    return accounts_data
+
+
+def _get_http_adapter():
+    global _http_adapter
+
+    # a single adapter (and so a single connection pool per host) is shared
+    # by all sessions, sessions only keep their own cookies
+    if _http_adapter is None:
+        retry = Retry(
+            total=_settings["http_retries"],
+            backoff_factor=_settings["http_backoff_factor"],
+            # statuses are handled in _http_get() to hold the rate limiter
+            status_forcelist=(),
+            respect_retry_after_header=False
+        )
+        _http_adapter = HTTPAdapter(
+            pool_connections=_settings["http_pool_size"],
+            pool_maxsize=_settings["http_pool_size"],
+            max_retries=retry
+        )
+
+    return _http_adapter
+
+
+def _create_session(cookies=None):
+    session = requests.Session()
+
+    adapter = _get_http_adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    if cookies:
+        session.cookies.update(cookies)
+
+    return session
+
+
+def _get_anonymous_session():
+    global _anonymous_session
+
+    if _anonymous_session is None:
+        _anonymous_session = _create_session()
+
+    return _anonymous_session
+
+
+def _get_session(auth_data):
+    return _create_session(auth_data["cookies"])
+
+
+def _get_rate_limiter(host):
+    rate_limits = _settings["rate_limits"]
+
+    key = "*"
+    for limited_host in rate_limits:
+        if host == limited_host or host.endswith("." + limited_host):
+            key = limited_host
+            break
+
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            rate, capacity = rate_limits[key]
+            limiter = {
+                "rate": float(rate),
+                "capacity": float(capacity),
+                "tokens": float(capacity),
+                "updated": time.time(),
+                "blocked_until": 0,
+                "throttled_until": 0,
+                "lock": threading.Lock(),
+            }
+            _rate_limiters[key] = limiter
+
+        return limiter
+
+
+def _acquire_rate_limit(limiter):
+    while True:
+        with limiter["lock"]:
+            now = time.time()
+            if now < limiter["blocked_until"]:
+                wait_time = limiter["blocked_until"] - now
+            else:
+                limiter["tokens"] = min(
+                    limiter["capacity"],
+                    limiter["tokens"] + (now - limiter["updated"]) * limiter["rate"])
+                limiter["updated"] = now
+
+                if limiter["tokens"] >= 1:
+                    limiter["tokens"] -= 1
+                    return
+
+                wait_time = (1 - limiter["tokens"]) / limiter["rate"]
+
+        time.sleep(wait_time)
+
+
+def _get_rate_limit_throttling(limiter):
+    with limiter["lock"]:
+        return max(0, limiter["throttled_until"] - time.time())
+
+
+def _block_rate_limit(limiter, delay, throttled=False):
+    with limiter["lock"]:
+        limiter["blocked_until"] = max(limiter["blocked_until"], time.time() + delay)
+        if throttled:
+            limiter["throttled_until"] = max(limiter["throttled_until"], time.time() + delay)
+        limiter["tokens"] = 0
+
+
+def _get_retry_after(response):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).
+                   total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_get(url, session=None, endpoint=None, stream=False, retry_throttled=True):
+    if session is None:
+        session = _get_anonymous_session()
+
+    host = urlparse(url).hostname or ""
+    limiter = _get_rate_limiter(host)
+    if endpoint is None:
+        endpoint = host
+
+    attempt = 0
+    while True:
+        # callers which can't wait for long, like drop checks, are told when to come back
+        # if the host throttles requests, server errors are retried as usual
+        if not retry_throttled:
+            throttled_time = _get_rate_limit_throttling(limiter)
+            if throttled_time:
+                raise TooManyRequestsException(
+                    "Requests to {0} are held".format(host), throttled_time)
+
+        _acquire_rate_limit(limiter)
+
+        with _timed("http_request_seconds", endpoint=endpoint):
+            response = session.get(url, stream=stream,
+                                   timeout=(_settings["http_connect_timeout"],
+                                            _settings["http_read_timeout"]))
+        _increment("http_responses_total", endpoint=endpoint, status=response.status_code)
+
+        if response.status_code != 429 and response.status_code < 500:
+            # a streamed body is counted by the one who reads it
+            if not stream:
+                _increment("http_response_bytes_total", len(response.content),
+                           endpoint=endpoint)
+            return response
+
+        _increment("http_response_bytes_total", len(response.content), endpoint=endpoint)
+
+        # all the requests to the host wait, not only the failed one
+        delay = _get_retry_after(response)
+        if delay is None:
+            delay = _settings["http_backoff_factor"] * (2 ** attempt)
+        _block_rate_limit(limiter, delay, response.status_code == 429)
+
+        attempt += 1
+        if attempt > _settings["http_retries"] or \
+                (response.status_code == 429 and not retry_throttled):
+            if response.status_code == 429:
+                raise TooManyRequestsException(
+                    "Too many requests to {0}".format(host), delay)
+            return response
+
+        logging.debug("Got %s from %s, retrying in %s seconds", response.status_code, host, delay)
+
+
+def _get_page(url, session=None, parse_only=None, endpoint=None):
+    page = _http_get(url, session, endpoint)
+    with _timed("parse_seconds", page=endpoint):
+        return BeautifulSoup(page.text, _settings["html_parser"], parse_only=parse_only)
+
+
+def _get_badges_page_url(page_number, profile_name, sort=None):
+    return (_settings["steam_community_url"] + "/profiles/" + profile_name +
+            "/badges/?p=" + str(page_number) + ("&sort=" + sort if sort else ""))
+
+
+def _get_badges_page(page_number, profile_name, session):
+    return _get_page(_get_badges_page_url(page_number, profile_name), session,
+                     parse_only=_BADGES_PAGE_STRAINER, endpoint="badges")
+
+
+def _get_badge_page(game_id, profile_name, session):
+    return _http_get(
+        _settings["steam_community_url"] + "/profiles/" + profile_name +
+        "/gamecards/" + str(game_id),
+        session, endpoint="gamecards", retry_throttled=False
+    ).text
+
+
+def _probe_badge_page(game_id, profile_name, session):
+    response = _http_get(
+        _settings["steam_community_url"] + "/profiles/" + profile_name +
+        "/gamecards/" + str(game_id),
+        session, endpoint="gamecards", stream=True, retry_throttled=False
+    )
+
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+    page_text = ""
+    read_bytes = 0
+    authorized = False
+    progress_match = None
+    try:
+        chunks = response.iter_content(chunk_size=_BADGE_PAGE_PROBE_CHUNK_SIZE)
+        for chunk in chunks:
+            read_bytes += len(chunk)
+            start = max(0, len(page_text) - _BADGE_PAGE_PROBE_OVERLAP)
+            page_text += decoder.decode(chunk)
+
+            if not authorized:
+                authorized = _USER_AVATAR_RE.search(page_text, start) is not None
+            if progress_match is None:
+                progress_match = _PROGRESS_INFO_RE.search(page_text, start)
+
+            if authorized and progress_match is not None:
+                try:
+                    return True, _parse_card_drops_text(progress_match.group(1))
+                except ValueError:
+                    logging.debug("Fast badge page parsing failed, falling back to full parsing")
+                    break
+
+        # the rest of the page is needed for full parsing
+        for chunk in chunks:
+            read_bytes += len(chunk)
+            page_text += decoder.decode(chunk)
+        page_text += decoder.decode(b"", True)
+    finally:
+        # the connection is dropped if the body wasn't read to the end
+        response.close()
+        _increment("http_response_bytes_total", read_bytes, endpoint="gamecards")
+
+    if not page_text:
+        raise Exception("Error getting badge page")
+
+    return _parse_badge_page(page_text)
+
+
+def _get_db():
+    global _db
+
+    with _db_lock:
+        if _db is None:
+            # the connection is shared by executor threads, access is serialized by the lock
+            db = sqlite3.connect(_settings["state_db"], check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(_STATE_DB_SCHEMA)
+            _db = db
+
+        return _db
+
+
+def _close_db():
+    global _db
+
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+            _db = None
+
+
+def _commit_db():
+    with _db_lock:
+        _get_db().commit()
+
+
+def _get_cached_value(table, key, ttl):
+    with _db_lock:
+        row = _get_db().execute(
+            "SELECT value FROM {0} WHERE id = ? AND time > ?".format(table),
+            (key, time.time() - ttl)).fetchone()
+
+    return row[0] if row is not None else None
+
+
+def _set_cached_value(table, key, value):
+    with _db_lock:
+        _get_db().execute(
+            "INSERT OR REPLACE INTO {0} (id, value, time) VALUES (?, ?, ?)".format(table),
+            (key, value, time.time()))
+
+
+def _request_game_name(game_id):
+    page = _http_get(_settings["steam_store_url"] + "/api/appdetails/" +
+                     "?filters=basic&appids=" + str(game_id), endpoint="appdetails")
+    return json.loads(page.text)[str(game_id)]["data"]["name"]
+
+
+def _get_game_name(game_id):
+    game_name = _get_cached_value(GAME_NAMES_TABLE, game_id,
+                                  _settings["game_names_cache_ttl"])
+
+    if game_name is None:
+        game_name = _request_game_name(game_id)
+        _set_cached_value(GAME_NAMES_TABLE, game_id, game_name)
+        _commit_db()
+
+    return game_name
+
+
+def _prefetch_game_names(game_ids, stopped=None):
+    ttl = _settings["game_names_cache_ttl"]
+    missing_ids = [game_id for game_id in set(game_ids)
+                   if _get_cached_value(GAME_NAMES_TABLE, game_id, ttl) is None]
+    if not missing_ids:
+        return
+
+    logging.info("Requesting names of %s game(s)", len(missing_ids))
+
+    def request(game_id):
+        if stopped is not None and stopped.is_set():
+            return None
+
+        try:
+            return _request_game_name(game_id)
+        except Exception as e:
+            logging.debug("Exception on getting game name for %s: %s", game_id, e)
+            return None
+
+    # the store API doesn't support several appids at once with "basic" filter,
+    # so the requests are sent in parallel instead
+    with ThreadPoolExecutor(max_workers=_settings["store_api_concurrency"]) as executor:
+        for game_id, game_name in zip(missing_ids, executor.map(request, missing_ids)):
+            if game_name is not None:
+                _set_cached_value(GAME_NAMES_TABLE, game_id, game_name)
+
+    _commit_db()
+
+
+def _seed_game_names(badges_data):
+    seeded = False
+    for badge_info in badges_data:
+        if badge_info.is_game and badge_info.title:
+            _set_cached_value(GAME_NAMES_TABLE, badge_info.id, badge_info.title)
+            seeded = True
+
+    if seeded:
+        _commit_db()
+
+
+def _check_authorization(page):
+    return page.find("a", {"class": "user_avatar"}) is not None
+
+
+def _get_authorized_badges_page(page_number, profile_name, session):
+    badges_page_data = _get_badges_page(page_number, profile_name, session)
+
+    if not _check_authorization(badges_page_data):
+        raise NotAuthorizedException("Not authorized")
+
+    return badges_page_data
+
+
+def _iter_badges_pages(profile_name, session, select_pages=None):
+    logging.info("Requesting badges page")
+    badges_page_data = _get_authorized_badges_page(1, profile_name, session)
+
+    badge_pages_count = 1
+    links = badges_page_data.find_all("a", {"class": "pagelink"})
+    if links:
+        badge_pages_count = int(links[-1].text)
+        logging.info("Found %s more page(s)", badge_pages_count - 1)
+
+    logging.info("Processing badges page")
+    yield 1, badges_page_data
+    badges_page_data = None
+
+    if select_pages:
+        page_numbers = sorted(set(select_pages(badge_pages_count)) - set([1]))
+    else:
+        page_numbers = list(range(2, badge_pages_count + 1))
+
+    if not page_numbers:
+        return
+
+    concurrency = _settings["badge_pages_concurrency"]
+    logging.info("Requesting %s more badges page(s), %s at a time", len(page_numbers), concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # only a few pages are requested ahead of the one being processed,
+        # so the number of pages held in memory doesn't depend on the library size
+        pending = deque()
+        for page_number in page_numbers:
+            pending.append((page_number, executor.submit(
+                _get_authorized_badges_page, page_number, profile_name, session)))
+
+            if len(pending) < concurrency:
+                continue
+
+            page_number, future = pending.popleft()
+            logging.info("Processing badges page %s of %s", page_number, badge_pages_count)
+            yield page_number, future.result()
+
+        while pending:
+            page_number, future = pending.popleft()
+            logging.info("Processing badges page %s of %s", page_number, badge_pages_count)
+            yield page_number, future.result()
+
+
+def _iter_badges_data(profile_name, session, select_pages=None):
+    for page_number, badges_page_data in _iter_badges_pages(profile_name, session, select_pages):
+        for badge in badges_page_data.find_all("div", {"class": "badge_row"}):
+            yield page_number, badge
+
+        # rows reference the whole tree, so it is freed explicitly
+        badges_page_data.decompose()
+
+
+def _parse_badge_row_link(badge):
+    link = badge.find("a", {"class": "badge_row_overlay"})["href"]
+    splitted = link.split("/")
+    game_id = int(splitted[6]) if len(splitted) >= 7 else -1
+
+    return game_id, "gamecards" in link
+
+
+def _parse_badges_page_card_drops(page_text):
+    with _timed("parse_seconds", page="badges_card_drops"):
+        return _parse_badges_page_card_drops_text(page_text)
+
+
+def _parse_badges_page_card_drops_text(page_text):
+    # fast path: only the counters are needed, so rows are cut out of the text
+    # at their overlay links instead of building a tree
+    rows = list(_BADGE_ROW_OVERLAY_RE.finditer(page_text))
+    if rows:
+        card_drops = {}
+        try:
+            for i, row in enumerate(rows):
+                link_match = _GAMECARDS_LINK_RE.search(row.group(0))
+                if not link_match:
+                    continue
+                end = rows[i + 1].start() if i + 1 < len(rows) else len(page_text)
+                progress_match = _PROGRESS_INFO_RE.search(page_text, row.end(), end)
+                if progress_match:
+                    card_drops[int(link_match.group(1))] = \
+                        _parse_card_drops_text(progress_match.group(1))
+
+            return _USER_AVATAR_RE.search(page_text) is not None, card_drops
+        except ValueError:
+            logging.debug("Fast badges page parsing failed, falling back to full parsing")
+
+    badges_page_data = BeautifulSoup(page_text, _settings["html_parser"],
+                                     parse_only=_BADGES_PAGE_STRAINER)
+    authorized = _check_authorization(badges_page_data)
+
+    card_drops = {}
+    for badge in badges_page_data.find_all("div", {"class": "badge_row"}):
+        game_id, is_game = _parse_badge_row_link(badge)
+        title_stats = badge.find("div", {"class": "badge_title_stats"})
+        if not is_game or not title_stats:
+            continue
+
+        card_drops_remaining = _parse_remaining_card_drops(title_stats)
+        if card_drops_remaining is not None:
+            card_drops[game_id] = card_drops_remaining
+
+    badges_page_data.decompose()
+
+    return authorized, card_drops
+
+
+def _get_stored_badge_pages(profile_name, game_ids):
+    with _db_lock:
+        rows = _get_db().execute(
+            "SELECT id, page FROM badges WHERE profile = ? AND id IN ({0})".format(
+                ", ".join("?" * len(game_ids))), [profile_name] + list(game_ids)).fetchall()
+
+    return dict((game_id, page) for game_id, page in rows if page)
+
+
+def _get_badges_pages_card_drops(game_ids, profile_name, session):
+    sort = _settings["batch_drop_checks_sort"]
+    if sort:
+        # games being idled are expected to be on the first page with this sorting
+        page_numbers = [1]
+    else:
+        pages = _get_stored_badge_pages(profile_name, game_ids)
+        page_numbers = sorted(set(pages.get(game_id, 1) for game_id in game_ids))
+
+    card_drops = {}
+    for page_number in page_numbers:
+        page_text = _http_get(_get_badges_page_url(page_number, profile_name, sort), session,
+                              endpoint="badges", retry_throttled=False).text
+        authorized, page_card_drops = _parse_badges_page_card_drops(page_text)
+        if not authorized:
+            raise NotAuthorizedException("Not authorized")
+        card_drops.update(page_card_drops)
+
+    return dict((game_id, card_drops[game_id]) for game_id in game_ids if game_id in card_drops)
+
+
+def _parse_card_drops_text(card_drops_text):
+    if "No card drops remaining" in card_drops_text:
+        return 0
+    else:
+        return int(card_drops_text.split(" ", 1)[0])
+
+
+def _parse_remaining_card_drops(page_part):
+    progress_info_data = page_part.find("span", {"class": "progress_info_bold"})
+    if not progress_info_data:
+        card_drops_remaining = None
+    else:
+        card_drops_remaining = _parse_card_drops_text(progress_info_data.text.strip())
+
+    return card_drops_remaining
+
+
+def _parse_badge_page(page_text):
+    with _timed("parse_seconds", page="gamecards"):
+        return _parse_badge_page_text(page_text)
+
+
+def _parse_badge_page_text(page_text):
+    # fast path: the page is only needed for a single counter,
+    # so try to get it without building a tree
+    match = _PROGRESS_INFO_RE.search(page_text)
+    if match:
+        try:
+            return (_USER_AVATAR_RE.search(page_text) is not None,
+                    _parse_card_drops_text(match.group(1)))
+        except ValueError:
+            logging.debug("Fast badge page parsing failed, falling back to full parsing")
+
+    page = BeautifulSoup(page_text, _settings["html_parser"],
+                         parse_only=_BADGE_PAGE_STRAINER)
+    return _check_authorization(page), _parse_remaining_card_drops(page)
+
+
+def _get_average_card_price(game_id):
+    result = _http_get(
+        _settings["average_card_price_url"] + "/market_data/average_card_price/" +
+        "?cur=usd&appid=" + str(game_id), endpoint="average_card_price")
+    try:
+        return float(result.text)
+    except ValueError:
+        raise Exception("Couldn't get average card price for game_id: " +
+                        str(game_id))
+
+
+def _gather_average_card_prices(game_ids):
+    ttl = _settings["average_card_prices_cache_ttl"]
+
+    average_card_prices = {}
+    missing_ids = []
+    for game_id in game_ids:
+        price = _get_cached_value(AVERAGE_CARD_PRICES_TABLE, game_id, ttl)
+        if price is None:
+            missing_ids.append(game_id)
+        else:
+            average_card_prices[game_id] = price
+
+    if not missing_ids:
+        return average_card_prices
+
+    logging.info("Requesting average card prices for %s game(s)", len(missing_ids))
+
+    def request(game_id):
+        try:
+            return _get_average_card_price(game_id)
+        except Exception as e:
+            logging.warning("Exception on getting average card price: %s", e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=_settings["price_api_concurrency"]) as executor:
+        for game_id, price in zip(missing_ids, executor.map(request, missing_ids)):
+            if price is not None:
+                average_card_prices[game_id] = price
+                _set_cached_value(AVERAGE_CARD_PRICES_TABLE, game_id, price)
+
+    _commit_db()
+
+    return average_card_prices
+
+
+def _parse_idle_list_options(filters=None, sort=None):
+    games_only = True
+    with_remaining_card_drops = True
+    with_playtime = False
+    if filters:
+        for flt in filters:
+            if flt == FILTER_NOT_ONLY_GAMES:
+                games_only = False
+            elif flt == FILTER_NOT_ONLY_WITH_CARD_DROPS:
+                with_remaining_card_drops = False
+            elif flt == FILTER_WITH_PLAYTIME:
+                with_playtime = True
+            else:
+                raise Exception('Filter "{0}" is not supported'.format(flt))
+
+    sort_type = None
+    sort_reverse = True
+    if sort:
+        if sort == SORT_LEAST_REMAINING_DROPS:
+            sort_type = 1
+            sort_reverse = False
+        elif sort == SORT_MOST_REMAINING_DROPS:
+            sort_type = 1
+            sort_reverse = True
+        elif sort == SORT_LEAST_AVERAGE_CARD_PRICE:
+            sort_type = 2
+            sort_reverse = False
+        elif sort == SORT_MOST_AVERAGE_CARD_PRICE:
+            sort_type = 2
+            sort_reverse = True
+        elif sort == SORT_MOST_CARDS_PER_HOUR:
+            sort_type = 3
+            sort_reverse = True
+        elif sort == SORT_MOST_VALUE_PER_HOUR:
+            sort_type = 4
+            sort_reverse = True
+        else:
+            raise Exception('Sort method "{0}" is not supported'.format(sort))
+
+    return games_only, with_remaining_card_drops, with_playtime, sort_type, sort_reverse
+
+
+def _get_drop_intervals_by_game(profile_name):
+    intervals = {}
+    if profile_name is None:
+        return intervals
+
+    with _db_lock:
+        rows = _get_db().execute(
+            "SELECT game_id, drop_interval FROM drop_events WHERE profile = ?",
+            (profile_name,)).fetchall()
+
+    for game_id, interval in rows:
+        intervals.setdefault(game_id, []).append(interval)
+
+    return intervals
+
+
+def _estimate_idle_hours(card_drops_remaining, playtime, drop_interval):
+    # cards don't drop until the game has been played for a while
+    priming_hours = max(0.0, _settings["priming_playtime"] - (playtime or 0.0))
+    return priming_hours + card_drops_remaining * drop_interval / 3600.0
+
+
+def _plan_idle_slots(estimates, slots):
+    # each game goes to the slot which gets free first
+    slot_end_hours = [0.0] * slots
+    plan = []
+    for game_id, score, hours, card_drops in estimates:
+        slot = slot_end_hours.index(min(slot_end_hours))
+        plan.append({
+            "id": game_id,
+            "slot": slot,
+            "start_hours": slot_end_hours[slot],
+            "end_hours": slot_end_hours[slot] + hours,
+            "card_drops": card_drops,
+        })
+        slot_end_hours[slot] += hours
+
+    return plan
+
+
+def _score_idle_list(candidates, profile_name=None, by_value=False):
+    # candidates are (game_id, title, card_drops_remaining, playtime) tuples
+    game_intervals = _get_drop_intervals_by_game(profile_name)
+    default_interval = None
+    if profile_name is not None:
+        default_interval = _get_expected_drop_interval(_get_drop_history(profile_name))
+    if default_interval is None:
+        default_interval = _settings["default_drop_interval"]
+
+    if by_value:
+        average_card_prices = _gather_average_card_prices(
+            [game_id for game_id, title, card_drops, playtime in candidates])
+
+    estimates = []
+    for game_id, title, card_drops, playtime in candidates:
+        card_drops = card_drops or 0
+
+        # a few drops of the game itself say more than drops of all the games
+        intervals = game_intervals.get(game_id, [])
+        if len(intervals) >= _MIN_GAME_DROP_INTERVALS:
+            drop_interval = _get_expected_drop_interval(intervals)
+        else:
+            drop_interval = default_interval
+
+        hours = _estimate_idle_hours(card_drops, playtime, drop_interval)
+        score = card_drops / hours if hours else 0.0
+
+        if by_value:
+            price = average_card_prices.get(game_id, _settings["default_average_card_price"])
+            if price is None:
+                logging.warning('Skipped game without average card price: %s', title)
+                continue
+            score *= price
+
+        estimates.append((game_id, score, hours, card_drops))
+
+    # games giving the most per hour go first, so the most is got soonest
+    estimates.sort(key=itemgetter(1), reverse=True)
+
+    plan = _plan_idle_slots(estimates, _settings["idle_slots"])
+    if plan:
+        total_hours = max(entry["end_hours"] for entry in plan)
+        total_card_drops = sum(entry["card_drops"] for entry in plan)
+        logging.info("Estimated %s card drop(s) in %s with %s slot(s)", total_card_drops,
+                     timedelta(hours=round(total_hours, 2)), _settings["idle_slots"])
+        for entry in plan:
+            logging.debug("Slot %s: game %s from %.2f to %.2f hours, %s card drop(s)",
+                          entry["slot"], entry["id"], entry["start_hours"],
+                          entry["end_hours"], entry["card_drops"])
+
+    return [game_id for game_id, score, hours, card_drops in estimates]
+
+
+def _generate_idle_list(badges_data, blacklist=None, whitelist=None,
+                        filters=None, sort=None, profile_name=None):
+    games_only, with_remaining_card_drops, with_playtime, sort_type, sort_reverse = \
+        _parse_idle_list_options(filters, sort)
+
+    filtered_badges_data = []
+
+    for badge_info in badges_data:
+        if whitelist and badge_info.id not in whitelist:
+            continue
+        if blacklist and badge_info.id in blacklist:
+            continue
+
+        if games_only and not badge_info.is_game:
+            continue
+        if with_remaining_card_drops and not badge_info.card_drops_remaining:
+            continue
+        if with_playtime and not badge_info.playtime:
+            continue
+
+        filtered_badges_data.append(badge_info)
+
+    if sort_type in (3, 4):
+        return _score_idle_list(
+            [(badge_info.id, badge_info.title, badge_info.card_drops_remaining,
+              badge_info.playtime) for badge_info in filtered_badges_data],
+            profile_name, by_value=sort_type == 4)
+
+    if sort_type == 2:
+        average_card_prices = _gather_average_card_prices(
+            [badge_info.id for badge_info in filtered_badges_data])
+
+    tmp_list = [] if sort_type else None
+    idle_list = []
+
+    for badge_info in filtered_badges_data:
+        if sort_type == 1:
+            sort_value = badge_info.card_drops_remaining
+        elif sort_type == 2:
+            sort_value = average_card_prices.get(
+                badge_info.id, _settings["default_average_card_price"])
+            if sort_value is None:
+                logging.warning('Skipped game without average card price: %s', badge_info.title)
+                continue
+        else:
+            sort_value = None
+
+        if sort_type:
+            tmp_list.append((badge_info.id, sort_value))
+        else:
+            idle_list.append(badge_info.id)
+
+    if sort_type:
+        tmp_list.sort(key=itemgetter(1), reverse=sort_reverse)
+
+        idle_list = [game_id for game_id, value in tmp_list]
+
+    return idle_list
+
+
+def _query_idle_list(profile_name, blacklist=None, whitelist=None,
+                     filters=None, sort=None):
+    games_only, with_remaining_card_drops, with_playtime, sort_type, sort_reverse = \
+        _parse_idle_list_options(filters, sort)
+
+    conditions = ["b.profile = ?"]
+    parameters = [profile_name]
+    if whitelist:
+        conditions.append("b.id IN ({0})".format(", ".join("?" * len(whitelist))))
+        parameters.extend(whitelist)
+    if blacklist:
+        conditions.append("b.id NOT IN ({0})".format(", ".join("?" * len(blacklist))))
+        parameters.extend(blacklist)
+    if games_only:
+        conditions.append("b.is_game = 1")
+    if with_remaining_card_drops:
+        conditions.append("b.card_drops_remaining > 0")
+    if with_playtime:
+        conditions.append("b.playtime > 0")
+    where = " AND ".join(conditions)
+
+    if sort_type == 2:
+        with _db_lock:
+            game_ids = [row[0] for row in _get_db().execute(
+                "SELECT b.id FROM badges b WHERE " + where, parameters)]
+        # fills the cache the query below reads the prices from
+        _gather_average_card_prices(game_ids)
+
+    if sort_type in (3, 4):
+        with _db_lock:
+            candidates = _get_db().execute(
+                "SELECT b.id, b.title, b.card_drops_remaining, b.playtime FROM badges b" +
+                " WHERE " + where + " ORDER BY b.page, b.rowid", parameters).fetchall()
+        return _score_idle_list(candidates, profile_name, by_value=sort_type == 4)
+
+    order = " DESC" if sort_reverse else ""
+    if sort_type == 1:
+        query = ("SELECT b.id, b.title, b.card_drops_remaining FROM badges b WHERE " + where +
+                 " ORDER BY b.card_drops_remaining" + order + ", b.page, b.rowid")
+    elif sort_type == 2:
+        query = ("SELECT b.id, b.title, COALESCE(p.value, ?) FROM badges b" +
+                 " LEFT JOIN average_card_prices p ON p.id = b.id AND p.time > ?" +
+                 " WHERE " + where +
+                 " ORDER BY COALESCE(p.value, ?)" + order + ", b.page, b.rowid")
+        default_price = _settings["default_average_card_price"]
+        ttl = _settings["average_card_prices_cache_ttl"]
+        parameters = [default_price, time.time() - ttl] + parameters + [default_price]
+    else:
+        query = ("SELECT b.id, b.title, NULL FROM badges b WHERE " + where +
+                 " ORDER BY b.page, b.rowid")
+
+    with _db_lock:
+        rows = _get_db().execute(query, parameters).fetchall()
+
+    idle_list = []
+    for game_id, title, sort_value in rows:
+        if sort_type == 2 and sort_value is None:
+            logging.warning('Skipped game without average card price: %s', title)
+            continue
+        idle_list.append(game_id)
+
+    return idle_list
+
+
+def _write_id_list_to_file(id_list, filename):
+    with open(filename, "w") as f:
+        for game_id in id_list:
+            f.write("{}\n".format(game_id))
+
+
+def _read_id_list_from_file(filename):
+    with(open(filename)) as f:
+        return [int(line.rstrip("\n")) for line in f]
+
+
+def _iter_badges_info(profile_name, session, blacklist=None, whitelist=None,
+                      select_pages=None):
+    start_time = time.time()
+
+    for page_number, badge in _iter_badges_data(profile_name, session, select_pages):
+        badge_info = BadgeInfo(page=page_number)
+        badge_info.id, badge_info.is_game = _parse_badge_row_link(badge)
+
+        badge_info.title = badge.find("div", {"class": "badge_title"}).contents[0].strip()
+
+        if whitelist and badge_info.id not in whitelist:
+            logging.info("Skipped badge for not whitelisted game: %s", badge_info.title)
+            continue
+
+        if blacklist and badge_info.id in blacklist:
+            logging.info("Skipped badge for blacklisted game: %s", badge_info.title)
+            continue
+
+        title_stats = badge.find("div", {"class": "badge_title_stats"})
+        if title_stats:
+            badge_info.has_stats = True
+            badge_info.card_drops_remaining = _parse_remaining_card_drops(title_stats)
+
+            playtime_info = title_stats.find("div", {"class": "badge_title_stats_playtime"}).string
+            if playtime_info and "hrs on record" in playtime_info:
+                badge_info.playtime = float(playtime_info.split(" ", 1)[0].strip().
+                                            replace(",", ""))
+            else:
+                badge_info.playtime = 0.0
+
+        badge_progress_info = badge.find("div", {"class": "badge_progress_info"})
+        if badge_progress_info:
+            badge_progress_info_text = badge_progress_info.text.strip()
+            if badge_progress_info_text:
+                if " cards collected" in badge_progress_info_text:
+                    splitted = badge_progress_info_text.split(" ", 3)
+                    if len(splitted) > 3:  # yeah, at least 4
+                        badge_info.cards_collected = int(splitted[0])
+                        badge_info.cards_total = int(splitted[2])
+                elif "Ready" in badge_progress_info_text:
+                    badge_info.badge_ready = True
+
+        if badge_info.is_game and badge_info.title:
+            _set_cached_value(GAME_NAMES_TABLE, badge_info.id, badge_info.title)
+
+        yield badge_info
+
+    _commit_db()
+
+    _observe("gather_badges_info_seconds", time.time() - start_time)
+
+
+def _gather_badges_info(profile_name, session, blacklist=None, whitelist=None,
+                        select_pages=None):
+    return list(_iter_badges_info(profile_name, session, blacklist=blacklist,
+                                  whitelist=whitelist, select_pages=select_pages))
+
+
+def _store_badges_info(profile_name, badges, removed_keys=(), replace=False):
+    columns = BadgeInfo.__slots__
+    insert = "INSERT OR REPLACE INTO badges (profile, {0}, updated) VALUES (?, {1}, ?)".format(
+        ", ".join(columns), ", ".join("?" * len(columns)))
+    now = time.time()
+
+    # badges may come from a scan of badges pages, which mustn't hold the lock
+    # other threads record drops with, so they are collected first
+    rows = [[profile_name] + [getattr(badge_info, column) for column in columns] + [now]
+            for badge_info in badges]
+
+    with _db_lock:
+        db = _get_db()
+        # the whole update is a single transaction, so an interrupted scan
+        # leaves the previously stored badges intact
+        with db:
+            if replace:
+                db.execute("DELETE FROM badges WHERE profile = ?", (profile_name,))
+            db.executemany(insert, rows)
+            for game_id, title in removed_keys:
+                db.execute("DELETE FROM badges WHERE profile = ? AND id = ? AND title = ?",
+                           (profile_name, game_id, title))
+
+    return len(rows)
+
+
+def _load_stored_badges_info(profile_name):
+    with _db_lock:
+        rows = _get_db().execute(
+            "SELECT " + ", ".join(BadgeInfo.__slots__) + " FROM badges WHERE profile = ?" +
+            " ORDER BY page, rowid", (profile_name,)).fetchall()
+
+    badges = []
+    for row in rows:
+        badge_info = BadgeInfo(*row)
+        badge_info.is_game = bool(badge_info.is_game)
+        badge_info.has_stats = bool(badge_info.has_stats)
+        badge_info.badge_ready = bool(badge_info.badge_ready)
+        badges.append(badge_info)
+
+    return badges
+
+
+def _get_badge_key(badge_info):
+    # badges not related to games all have -1 as id
+    return badge_info.id, badge_info.title
+
+
+def _is_badge_likely_to_change(badge_info):
+    return bool(badge_info.card_drops_remaining or not badge_info.has_stats or
+                badge_info.badge_ready)
+
+
+def _save_badges_info(badges, filename):
+    # badges may be a stream, so they are written one by one
+    # in the same format json.dump(indent=4) has
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        separator = "[\n"
+        for badge_info in badges:
+            f.write(separator)
+            f.write("\n".join("    " + line for line in
+                              json.dumps(badge_info.to_dict(), indent=4).split("\n")))
+            separator = ",\n"
+        f.write("\n]" if separator != "[\n" else "[]")
+    os.replace(tmp_filename, filename)
+
+
+def _load_badges_info(filename):
+    with open(filename) as f:
+        return [BadgeInfo.from_dict(data) for data in json.load(f)]
+
+
+def _refresh_badges_info(previous_badges, profile_name, session):
+    previous_pages_count = max([badge_info.page or 0 for badge_info in previous_badges] or [0])
+
+    fetched_pages = set([1])
+
+    def select_pages(badge_pages_count):
+        if not previous_pages_count or badge_pages_count != previous_pages_count:
+            logging.info("Number of badges pages changed, refreshing all of them")
+            page_numbers = range(2, badge_pages_count + 1)
+        else:
+            page_numbers = set(badge_info.page for badge_info in previous_badges
+                               if _is_badge_likely_to_change(badge_info))
+
+        fetched_pages.update(page_numbers)
+        return page_numbers
+
+    badges = _gather_badges_info(profile_name, session, select_pages=select_pages)
+
+    fetched_keys = set(_get_badge_key(badge_info) for badge_info in badges)
+    full_refresh = fetched_pages.issuperset(range(1, previous_pages_count + 1))
+
+    # badges on pages that weren't fetched are kept, as well as the ones
+    # which may have moved to those pages, until the next full refresh
+    for badge_info in previous_badges:
+        if _get_badge_key(badge_info) in fetched_keys:
+            continue
+        if full_refresh:
+            continue
+        badges.append(badge_info)
+
+    badges.sort(key=lambda badge_info: badge_info.page or 0)
+
+    return badges
+
+
+def _diff_badges_info(previous_badges, badges):
+    previous = dict((_get_badge_key(badge_info), badge_info) for badge_info in previous_badges)
+    current = dict((_get_badge_key(badge_info), badge_info) for badge_info in badges)
+
+    diff = {
+        "new": [],
+        "removed": [],
+        "card_drops_remaining_changed": [],
+        "badge_ready": [],
+    }
+
+    for key, badge_info in current.items():
+        previous_badge_info = previous.get(key)
+        if previous_badge_info is None:
+            diff["new"].append(badge_info.to_dict())
+            continue
+
+        old_drops = previous_badge_info.card_drops_remaining
+        new_drops = badge_info.card_drops_remaining
+        if old_drops != new_drops:
+            diff["card_drops_remaining_changed"].append({
+                "id": badge_info.id,
+                "title": badge_info.title,
+                "old": old_drops,
+                "new": new_drops,
+            })
+
+        if badge_info.badge_ready and not previous_badge_info.badge_ready:
+            diff["badge_ready"].append(badge_info.to_dict())
+
+    for key, badge_info in previous.items():
+        if key not in current:
+            diff["removed"].append(badge_info.to_dict())
+
+    return diff
+
 
-def _get_auth_data(filename="config.json"):
-    with open(filename) as f:
-        config = json.load(f)
+def _now():
+    return _idle_environment["time"]()
 
-    cookies = config.get("cookies")
-    if cookies is None:
-        raise Exception('Incorrect config file: no "cookies" section')
 
-    if not cookies.get("steamRememberLogin") and not cookies.get("steamLoginSecure"):
-        raise Exception("Neither steamRememberLogin nor steamLoginSecure is set")
+def _new_idle_state(game_id, idler_args=None):
+    try:
+        game_name = _get_game_name(game_id)
+    except Exception as e:
+        game_name = '<Unknown>'
+        logging.warning("Exception on getting game name: %s", e)
 
+    logging.info('Processing game "%s" (%s)', game_name, game_id)
+
+    now = _now()
     return {
-        "cookies": cookies,
-        "profile_name": (cookies["steamRememberLogin"] or cookies["steamLoginSecure"])[:17]
+        "id": game_id,
+        "name": game_name,
+        "start_time": now,
+        "process": None,
+        "idle_start_time": None,
+        "idler_start_time": None,
+        "idler_failures": 0,
+        "last_idle_time": 0,
+        "remaining_card_drops": 1000,
+        "last_remaining_card_drops": 1000,
+        "last_drop_time": now,
+        "last_drop_idle_time": 0,
+        "last_check_time": now,
+        "next_check_time": now,
+        "erroneous_time_multiplier": 1,
+        "drop_intervals": [],
+        "idler_args": idler_args,
     }
 
 
-def _get_cookies(auth_data):
-    return auth_data["cookies"]
+def _resume_game(state):
+    if state["process"] is not None:
+        return False
 
+    state["process"] = _idle_environment["start_idler"](state["id"], state["idler_args"])
+    state["idler_start_time"] = _now()
+    # idle time is counted from the moment the idler is ready
+    state["idle_start_time"] = None
+    return True
 
-def _get_page(url, cookies=None):
-    page = requests.get(url, cookies=cookies)
-    return BeautifulSoup(page.text, "html.parser")
 
+def _mark_game_ready(state, reported=True):
+    if state["process"] is None or state["idle_start_time"] is not None:
+        return False
 
-def _get_badges_page(page_number, profile_name, cookies):
-    return _get_page(
-        "https://steamcommunity.com/profiles/" + profile_name +
-        "/badges/?p=" + str(page_number),
-        cookies=cookies
-    )
+    state["idle_start_time"] = _now()
+    state["idler_failures"] = 0
+    # an idler which didn't report readiness tells nothing about its latency
+    if reported:
+        _observe("idler_ready_seconds", state["idle_start_time"] - state["idler_start_time"],
+                 mode="warm" if _settings["idler_pool_size"] else "cold")
+    return True
 
 
-def _get_badge_page(game_id, profile_name, cookies):
-    return _get_page(
-        "https://steamcommunity.com/profiles/" + profile_name +
-        "/gamecards/" + str(game_id),
-        cookies=cookies
-    )
+def _count_idle_time(state):
+    if state["idle_start_time"] is not None:
+        state["last_idle_time"] += _now() - state["idle_start_time"]
+        state["idle_start_time"] = None
 
 
-def _get_game_name(game_id):
-    page = requests.get("https://store.steampowered.com/api/appdetails/" +
-                        "?filters=basic&appids=" + str(game_id))
-    return json.loads(page.text)[str(game_id)]["data"]["name"]
+def _pause_game(state):
+    if state["process"] is not None:
+        _idle_environment["stop_idler"](state["process"])
+        state["process"] = None
+        _count_idle_time(state)
 
 
-def _check_authorization(page):
-    return page.find("a", {"class": "user_avatar"}) is not None
+def _get_idle_time(state):
+    idle_time = state["last_idle_time"]
+    if state["process"] is not None and state["idle_start_time"] is not None:
+        idle_time += _now() - state["idle_start_time"]
 
+    return idle_time
 
-def _gather_badges_data(profile_name, cookies):
-    badges_data = []
 
-    current_page = 1
-    badge_pages_count = 1
-    while current_page <= badge_pages_count:
-        if badge_pages_count == 1:
-            logging.info("Requesting badges page")
-        else:
-            logging.info("Requesting badges page {0} of {1}".
-                         format(current_page, badge_pages_count))
+def _get_idler_restart_delay(state):
+    return min(_settings["idler_restart_delay"] * 2 ** state["idler_failures"],
+               _settings["idler_restart_max_delay"])
 
-        badges_page_data = _get_badges_page(current_page, profile_name, cookies)
 
-        if not _check_authorization(badges_page_data):
-            raise NotAuthorizedException("Not authorized")
+def _get_drop_history(profile_name):
+    with _db_lock:
+        rows = _get_db().execute(
+            "SELECT drop_interval FROM drop_events WHERE profile = ? ORDER BY rowid DESC LIMIT ?",
+            (profile_name, _settings["drop_history_size"])).fetchall()
 
-        if current_page == 1:
-            links = badges_page_data.find_all("a", {"class": "pagelink"})
-            if links:
-                badge_pages_count = int(links[-1].text)
-                logging.info("Found {0} more page(s)".format(badge_pages_count - 1))
+    return [row[0] for row in reversed(rows)]
 
-        logging.info("Processing badges page")
-        badges_data += badges_page_data.find_all("div", {"class": "badge_row"})
 
-        current_page += 1
+def _record_drop_interval(profile_name, state, history, interval):
+    history.append(interval)
+    del history[:-_settings["drop_history_size"]]
+    state["drop_intervals"].append(interval)
 
-    return badges_data
+    with _db_lock:
+        with _get_db() as db:
+            db.execute("INSERT INTO drop_events (profile, game_id, time, drop_interval)" +
+                       " VALUES (?, ?, ?, ?)", (profile_name, state["id"], _now(), interval))
 
 
-def _parse_remaining_card_drops(page_part):
-    progress_info_data = page_part.find("span", {"class": "progress_info_bold"})
-    if not progress_info_data:
-        card_drops_remaining = None
-    else:
-        card_drops_text = progress_info_data.text.strip()
-        if "No card drops remaining" in card_drops_text:
-            card_drops_remaining = 0
-        else:
-            card_drops_remaining = int(card_drops_text.split(" ", 1)[0])
+def _record_idle_history(profile_name, game_id, result, idle_time, dead_time):
+    with _db_lock:
+        with _get_db() as db:
+            db.execute("INSERT INTO idle_history (profile, game_id, time, result, idle_time," +
+                       " dead_time) VALUES (?, ?, ?, ?, ?, ?)",
+                       (profile_name, game_id, _now(), result, idle_time, dead_time))
 
-    return card_drops_remaining
 
+def _get_expected_drop_interval(history):
+    if not history:
+        return None
 
-def _get_average_card_price(game_id):
-    result = requests.get(
-        "http://api.enhancedsteam.com/market_data/average_card_price/" +
-        "?cur=usd&appid=" + str(game_id))
-    try:
-        return float(result.text)
-    except ValueError:
-        raise Exception("Couldn't get average card price for game_id: " +
-                        str(game_id))
+    return sorted(history)[len(history) // 2]
 
 
-def _generate_idle_list(badges_data, blacklist=None, whitelist=None,
-                        filters=None, sort=None):
-    games_only = True
-    with_remaining_card_drops = True
-    with_playtime = False
-    if filters:
-        for flt in filters:
-            if flt == FILTER_NOT_ONLY_GAMES:
-                games_only = False
-            elif flt == FILTER_NOT_ONLY_WITH_CARD_DROPS:
-                with_remaining_card_drops = False
-            elif flt == FILTER_WITH_PLAYTIME:
-                with_playtime = True
-            else:
-                raise Exception('Filter "{0}" is not supported'.format(flt))
+def _get_game_drop_interval(state, history):
+    # a few drops of the game itself say more than drops of all the games
+    if len(state["drop_intervals"]) >= _MIN_GAME_DROP_INTERVALS:
+        return _get_expected_drop_interval(state["drop_intervals"])
 
-    sort_type = None
-    sort_reverse = True
-    if sort:
-        if sort == SORT_LEAST_REMAINING_DROPS:
-            sort_type = 1
-            sort_reverse = False
-        elif sort == SORT_MOST_REMAINING_DROPS:
-            sort_type = 1
-            sort_reverse = True
-        elif sort == SORT_LEAST_AVERAGE_CARD_PRICE:
-            sort_type = 2
-            sort_reverse = False
-        elif sort == SORT_MOST_AVERAGE_CARD_PRICE:
-            sort_type = 2
-            sort_reverse = True
-        else:
-            raise Exception('Sort method "{0}" is not supported'.format(sort))
+    return _get_expected_drop_interval(history)
 
-    tmp_list = [] if sort_type else None
-    idle_list = []
 
-    for badge_info in badges_data:
-        if whitelist and badge_info["id"] not in whitelist:
-            continue
-        if blacklist and badge_info["id"] in blacklist:
-            continue
+def _get_drop_timeout(history):
+    expected_drop_interval = _get_expected_drop_interval(history)
+    if expected_drop_interval is None:
+        return _settings["drop_timeout"]
 
-        if games_only and not badge_info["is_game"]:
-            continue
-        if with_remaining_card_drops and not badge_info["card_drops_remaining"]:
-            continue
-        if with_playtime and not badge_info["playtime"]:
-            continue
+    return max(_settings["drop_timeout"], 3 * expected_drop_interval)
 
-        if sort_type == 1:
-            sort_value = badge_info["card_drops_remaining"]
-        elif sort_type == 2:
-            sort_value = _get_average_card_price(badge_info["id"])
-        else:
-            sort_value = None
 
-        if sort_type:
-            tmp_list.append((badge_info["id"], sort_value))
-        else:
-            idle_list.append(badge_info["id"])
+def _get_erroneous_poll_delay(state):
+    check_delay = 60 * state["erroneous_time_multiplier"]
+    state["erroneous_time_multiplier"] *= 2
 
-    if sort_type:
-        tmp_list.sort(key=itemgetter(1), reverse=sort_reverse)
+    return check_delay
 
-        idle_list = [game_id for game_id, value in tmp_list]
 
-    return idle_list
+def _fixed_poll_delay(state, history, erroneous_state):
+    if erroneous_state:
+        return _get_erroneous_poll_delay(state)
+    elif state["remaining_card_drops"] > 1:
+        return 10 * 60
+    else:
+        return 5 * 60
 
 
-def _write_id_list_to_file(id_list, filename):
-    with open(filename, "w") as f:
-        for game_id in id_list:
-            f.write("{}\n".format(game_id))
+def _adaptive_poll_delay(state, history, erroneous_state):
+    min_delay = _settings["poll_min_delay"]
+    max_delay = _settings["poll_max_delay"]
+    fixed_delay = _fixed_poll_delay(state, history, False)
+    remaining_card_drops = state["remaining_card_drops"]
+    if remaining_card_drops <= 2:
+        # the last drop finishes the game and the one before it makes checks more often,
+        # so they are looked for as often as with the fixed policy
+        max_delay = min(max_delay, fixed_delay)
 
+    if erroneous_state:
+        return min(_get_erroneous_poll_delay(state), max_delay)
 
-def _read_id_list_from_file(filename):
-    with(open(filename)) as f:
-        return [int(line.rstrip("\n")) for line in f]
+    expected_drop_interval = _get_game_drop_interval(state, history)
+    if expected_drop_interval is None or remaining_card_drops <= 2:
+        check_delay = fixed_delay
+    else:
+        # drops come for idle time, so it is used instead of the wall time
+        time_since_drop = _get_idle_time(state) - state["last_drop_idle_time"]
+        # until the game is down to its last two drops there is nothing to hurry for
+        time_until_drops = (remaining_card_drops - 2) * expected_drop_interval - time_since_drop
+
+        if time_until_drops > 0:
+            # check shortly after the drops are expected
+            check_delay = time_until_drops + _settings["poll_margin"]
+        else:
+            # the drops are late, back off the longer they are late
+            check_delay = -time_until_drops
+        check_delay = min(max(fixed_delay, check_delay), max_delay)
+
+    # there is no use waiting past the drop timeout
+    drop_timeout_delay = state["last_drop_time"] + _get_drop_timeout(history) - _now()
+    return max(min_delay, min(check_delay, drop_timeout_delay))
+
+
+_poll_policies = {
+    POLL_POLICY_FIXED: _fixed_poll_delay,
+    POLL_POLICY_ADAPTIVE: _adaptive_poll_delay,
+}
+
+
+def register_poll_policy(name, policy):
+    _poll_policies[name] = policy
+
+
+def _finish_game(profile_name, idle_list, state, skipped=False, keep=False,
+                 erroneous_state=False, throttled=False, journal=None):
+    _pause_game(state)
+
+    game_name = state["name"]
+    game_id = state["id"]
+
+    idle_time = state["last_idle_time"]
+    dead_time = _now() - state["start_time"] - idle_time
+    _increment("idle_seconds_total", idle_time, game=game_id)
+    _increment("dead_seconds_total", dead_time, game=game_id)
+
+    if skipped:
+        result = "skipped"
+    elif erroneous_state:
+        logging.warning("Stopped idling game because of continuous errors")
+        keep = True
+        result = "errors"
+    elif throttled and state["remaining_card_drops"]:
+        # drops which came while checks were throttled weren't seen
+        logging.warning("Stopped idling game because drop checks were throttled")
+        keep = True
+        result = "throttled"
+    elif state["remaining_card_drops"]:
+        logging.warning("Stopped idling game because drop timeout was reached")
+        result = "timeout"
+    else:
+        logging.info('Successfully finished idling "%s", idling time: %s',
+                     game_name, timedelta(seconds=state["last_idle_time"]))
+        result = "finished"
 
+    _record_idle_history(profile_name, game_id, result, idle_time, dead_time)
 
-def _gather_badges_info(profile_name, cookies, blacklist=None, whitelist=None):
-    badges = []
+    if keep:
+        logging.info('Moving game "%s" (%s) to the end of idle list', game_name, game_id)
+    else:
+        logging.info('Removing game "%s" (%s) from idle list', game_name, game_id)
+    idle_list.remove(game_id)
 
-    for badge in _gather_badges_data(profile_name, cookies):
-        badge_info = dict()
-        link = badge.find("a", {"class": "badge_row_overlay"})["href"]
-        splitted = link.split("/")
-        badge_info["id"] = int(splitted[6]) if len(splitted) >= 7 else -1
+    if keep:
+        idle_list.append(game_id)
 
-        if "gamecards" in link:
-            is_game = True
-        else:
-            is_game = False
-        badge_info["is_game"] = is_game
+    _write_journal_entry(journal, "rotated" if keep else "finished", game=game_id,
+                         result=result)
+    _log_metrics()
 
-        badge_info["title"] = badge.find("div", {"class": "badge_title"}).contents[0].strip()
+    logging.info("Games left %s", len(idle_list))
 
-        if whitelist and badge_info["id"] not in whitelist:
-            logging.info("Skipped badge for not whitelisted game: {0}".format(badge_info["title"]))
-            continue
 
-        if blacklist and badge_info["id"] in blacklist:
-            logging.info("Skipped badge for blacklisted game: {0}".format(badge_info["title"]))
-            continue
+_JOURNALED_STATE_KEYS = ("id", "name", "start_time", "remaining_card_drops",
+                         "last_remaining_card_drops", "last_drop_time", "last_drop_idle_time",
+                         "next_check_time", "erroneous_time_multiplier")
 
-        title_stats = badge.find("div", {"class": "badge_title_stats"})
-        if title_stats:
-            badge_info["card_drops_remaining"] = _parse_remaining_card_drops(title_stats)
 
-            playtime_info = title_stats.find("div", {"class": "badge_title_stats_playtime"}).string
-            if "hrs on record" in playtime_info:
-                badge_info["playtime"] = float(playtime_info.split(" ", 1)[0].strip())
-            else:
-                badge_info["playtime"] = 0
-        else:
-            badge_info["no_stats"] = True
+def _get_journal_filename(profile_name):
+    if not _settings["journal_file"]:
+        return None
 
-        badge_progress_info = badge.find("div", {"class": "badge_progress_info"})
-        cards_collected = None
-        cards_total = None
-        badge_ready = False
-        if badge_progress_info:
-            badge_progress_info_text = badge_progress_info.text.strip()
-            if badge_progress_info_text:
-                if " cards collected" in badge_progress_info_text:
-                    splitted = badge_progress_info_text.split(" ", 3)
-                    if len(splitted) > 3:  # yeah, at least 4
-                        cards_collected = splitted[0]
-                        cards_total = splitted[2]
-                elif "Ready" in badge_progress_info_text:
-                    badge_ready = True
+    return _settings["journal_file"].format(profile=profile_name)
 
-        badge_info["cards_collected"] = cards_collected
-        badge_info["cards_total"] = cards_total
-        badge_info["badge_ready"] = badge_ready
 
-        badges.append(badge_info)
+def _get_journal_entry(event, **fields):
+    fields["event"] = event
+    fields["time"] = _now()
+    return json.dumps(fields) + "\n"
 
-    return badges
 
+def _get_state_snapshot(state):
+    snapshot = dict((key, state[key]) for key in _JOURNALED_STATE_KEYS)
+    snapshot["last_idle_time"] = _get_idle_time(state)
+    return snapshot
 
-def _idle(idle_list, profile_name, cookies):
-    idling = False
 
-    erroneous_state = False
-    first_time_error_occurred = time.time()
+def _replay_journal(filename):
+    idle_list = None
+    source_list = None
+    snapshots = {}
+    last_time = None
 
-    index = -1
-    while index < len(idle_list) - 1:
-        index += 1
-        game_id = idle_list[index]
+    try:
+        f = open(filename)
+    except FileNotFoundError:
+        return idle_list, source_list, snapshots, last_time
 
-        if idling:
-            raise Exception("Still idling previous game, something went wrong")
+    with f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last entry may be torn by a crash
+                logging.warning("Skipped broken journal entry")
+                break
 
+            event = entry["event"]
+            last_time = entry["time"]
+            if event == "list":
+                idle_list = entry["idle_list"]
+                source_list = entry.get("source_list")
+                snapshots = {}
+            elif event in ("started", "checked", "dropped"):
+                snapshots[entry["state"]["id"]] = entry["state"]
+            elif event in ("finished", "rotated"):
+                game_id = entry["game"]
+                snapshots.pop(game_id, None)
+                idle_list.remove(game_id)
+                if event == "rotated":
+                    idle_list.append(game_id)
+
+    return idle_list, source_list, snapshots, last_time
+
+
+def _restore_idle_state(snapshot, downtime, idler_args=None):
+    state = dict(snapshot)
+    # the time the process wasn't running doesn't count towards drop timeout
+    for key in ("start_time", "last_drop_time", "next_check_time"):
+        state[key] += downtime
+    state["process"] = None
+    state["idle_start_time"] = None
+    state["idler_start_time"] = None
+    state["idler_failures"] = 0
+    state["last_check_time"] = state["last_drop_time"]
+    state["drop_intervals"] = []
+    state["idler_args"] = idler_args
+
+    logging.info('Resuming game "%s" (%s)', state["name"], state["id"])
+
+    return state
+
+
+def _open_journal(filename, idle_list, source_list, states):
+    # the journal starts over from the current list, so it doesn't grow forever
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(_get_journal_entry("list", idle_list=idle_list, source_list=source_list))
+        for state in states:
+            f.write(_get_journal_entry("started", state=_get_state_snapshot(state)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+    return open(filename, "a")
+
+
+def _write_journal_entry(journal, event, **fields):
+    if journal is None:
+        return
+
+    with _timed("journal_write_seconds"):
+        journal.write(_get_journal_entry(event, **fields))
+        journal.flush()
+        # only the data has to reach the disk, not the file metadata
+        getattr(os, "fdatasync", os.fsync)(journal.fileno())
+
+
+def _remove_journal(profile_name):
+    filename = _get_journal_filename(profile_name)
+    if filename and os.path.isfile(filename):
+        os.remove(filename)
+
+
+_COMMANDS_HELP = (
+    "Input command and press Enter\n" +
+    " p [n] - pause for n minutes (default: 5)\n" +
+    " r - resume\n" +
+    " n [id] - next (move current or specified game to the end of list)\n" +
+    " s [id] - skip (remove current or specified game from list)\n" +
+    " q - quit\n" +
+    "(anything else - recheck remaining cards and continue idling)")
+
+
+def _find_command_target(command, active_games):
+    splitted = command.split(" ")
+    if len(splitted) > 1:
         try:
-            game_name = _get_game_name(game_id)
-        except Exception as e:
-            game_name = '<Unknown>'
-            logging.warning("Exception on getting game name: {}".format(e))
+            game_id = int(splitted[1])
+        except ValueError:
+            game_id = None
 
-        logging.info('Processing game "{0}" ({1})'.format(game_name, game_id))
+        for state in active_games:
+            if state["id"] == game_id:
+                return state
 
-        command_skip = False
-        command_keep = False
-        command_quit = False
+        logging.warning("Game %s is not being idled", splitted[1])
+        return None
 
-        remaining_card_drops = 1000
+    return active_games[0] if active_games else None
 
-        idling_process = None
-        idle_start_time = time.time()  # not necessary
-        last_idle_time = 0
 
-        last_remaining_card_drops = 1000
-        last_drop_time = time.time()
-        erroneous_time_multiplier = 1
-        while last_drop_time + 5 * 60 * 60 > time.time():
-            try:
-                remaining_card_drops = get_game_remaining_card_drops(
-                    game_id, profile_name, cookies
-                )
+def _post_event(loop, events, event):
+    try:
+        loop.call_soon_threadsafe(events.put_nowait, event)
+        return True
+    except RuntimeError:  # the loop is closed
+        return False
 
-                if erroneous_state:
-                    erroneous_state = False
-                    erroneous_time_multiplier = 1
-                    logging.info("Recovered from erroneous state")
-            except Exception as e:
-                logging.warning("Exception on getting remaining card drops: {}".format(e))
-                if not erroneous_state:
-                    erroneous_state = True
-                    first_time_error_occurred = time.time()
-                elif first_time_error_occurred + 24 * 60 * 60 <= time.time():  # a day
-                    logging.warning("In erroneous state for too long, quiting")
-                    command_quit = True
-                    break
-                elif first_time_error_occurred + 5 * 60 <= time.time():  # 5 minutes
-                    _stop_idling(idling_process)
-                    idling = False
-                    last_idle_time += time.time() - idle_start_time
 
-            if remaining_card_drops < last_remaining_card_drops:
-                if last_remaining_card_drops != 1000:
-                    logging.info("Card was dropped")
-                last_remaining_card_drops = remaining_card_drops
-                last_drop_time = time.time()
+def _start_stdin_reader(loop, events):
+    def read():
+        while True:
+            try:
+                line = sys.stdin.readline()
+            except (ValueError, OSError):
+                return
+            if not line:
+                return
+            if not _post_event(loop, events, ("command", line.strip(), None)):
+                return
 
-                logging.info("Card drops remaining: {}".format(remaining_card_drops))
+    thread = threading.Thread(target=read, name="stdin-reader")
+    thread.daemon = True
+    thread.start()
 
-            if not remaining_card_drops:
-                break
 
-            if not idling:
-                idling_process = _start_idling(game_id)
-                idling = True
-                idle_start_time = time.time()
+async def _start_command_server(events, path):
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = asyncio.get_running_loop().create_future()
+                await events.put(("command", line.decode("utf-8").strip(), reply))
+                writer.write((await reply + "\n").encode("utf-8"))
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass  # the client is gone or idling is finished
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    logging.info("Listening for commands on %s", path)
+    return await asyncio.start_unix_server(handle, path=path)
+
+
+def _watch_idling_process(loop, events, state, process):
+    def watch():
+        # an idler reports on its stdout once it is idling, the pipe is closed when it exits
+        if process.stdout is not None:
+            for line in process.stdout:
+                line = line.strip()
+                if line == IDLER_READY_LINE:
+                    _post_event(loop, events, ("ready", state, process))
+                elif line:
+                    logging.debug('Idler for "%s": %s', state["name"], line)
+
+        process.wait()
+        _post_event(loop, events, ("exited", state, process))
+
+    # idlers which don't report readiness are assumed to be idling after a while
+    loop.call_later(_settings["idler_ready_timeout"], _post_event, loop, events,
+                    ("ready_timeout", state, process))
+
+    thread = threading.Thread(target=watch, name="idler-watcher-{0}".format(state["id"]))
+    thread.daemon = True
+    thread.start()
+
+
+def _idle(idle_list, profile_name, session, slots=None, idler_args=None):
+    try:
+        return asyncio.run(_idle_async(idle_list, profile_name, session, slots,
+                                       idler_args=idler_args))
+    except KeyboardInterrupt:
+        logging.info("Interrupted by user")
+        logging.info("Stopped idling list")
+        return idle_list
+
+
+async def _idle_async(idle_list, profile_name, session, slots=None, events=None,
+                      idler_args=None):
+    if slots is None:
+        slots = _settings["idle_slots"]
+
+    poll_policy = _poll_policies.get(_settings["poll_policy"])
+    if poll_policy is None:
+        raise Exception('Poll policy "{0}" is not supported'.format(_settings["poll_policy"]))
+
+    loop = asyncio.get_running_loop()
+
+    drop_history = _get_drop_history(profile_name)
+    game_drop_intervals = _get_drop_intervals_by_game(profile_name)
+
+    # games that were being idled when the process stopped continue
+    # with their timers, without checking them again
+    active_games = []
+    # the list as it was given, e.g. read from a file which is only updated
+    # once idling stops, tells if a journal left by a crash belongs to it
+    source_list = list(idle_list)
+    journal_filename = _get_journal_filename(profile_name)
+    if journal_filename:
+        journal_list, journal_source_list, snapshots, last_time = \
+            _replay_journal(journal_filename)
+        if journal_list is not None and journal_source_list != source_list:
+            logging.warning("Journal %s was left by another idle list, not resuming from it",
+                            journal_filename)
+        elif journal_list is not None:
+            logging.info("Resuming idle list from journal %s", journal_filename)
+            idle_list[:] = journal_list
+            downtime = _now() - last_time
+            active_games = [_restore_idle_state(snapshots[game_id], downtime, idler_args)
+                            for game_id in idle_list if game_id in snapshots][:slots]
+            for state in active_games:
+                state["drop_intervals"] = game_drop_intervals.setdefault(state["id"], [])
+
+    # names of the games started first are requested as they start, the rest are
+    # requested meanwhile, so idling and commands don't wait for the store API
+    prefetch_stopped = threading.Event()
+    loop.run_in_executor(None, _prefetch_game_names, idle_list[slots:], prefetch_stopped)
+
+    # commands come from the caller if it owns the input, e.g. in daemon mode
+    command_server = None
+    if events is None:
+        events = asyncio.Queue()
+
+        _start_stdin_reader(loop, events)
+        if _settings["command_socket"] and hasattr(asyncio, "start_unix_server"):
+            command_server = await _start_command_server(events, _settings["command_socket"])
+
+        logging.info(_COMMANDS_HELP)
 
-            if erroneous_state:
-                sleep_time = 60 * erroneous_time_multiplier
-                erroneous_time_multiplier *= 2
-            elif remaining_card_drops > 1:
-                sleep_time = 10 * 60
-            else:
-                sleep_time = 5 * 60
+    erroneous_state = False
+    first_time_error_occurred = _now()
 
-            logging.info("Gonna sleep for {} seconds".format(sleep_time))
-            logging.info("Press Ctrl+C to interrupt sleep and issue a command")
-            try:
-                time.sleep(sleep_time)
-            except KeyboardInterrupt:
-                logging.info("Sleep interrupted by user")
-                logging.info(
-                    "Input command and press Enter\n" +
-                    " p [n] - pause for n minutes (default: 5)\n" +
-                    " n - next (move current game to the end of list)\n" +
-                    " s - skip (remove current game from list)\n" +
-                    " q - quit\n" +
-                    "(anything else - recheck remaining cards and continue idling)")
-                try:
-                    command = _input("> ").strip()
-                except KeyboardInterrupt or EOFError:
-                    command = ""
-
-                logging.debug('Got command from user: "{}"'.format(command))
-                if command.startswith("p"):
-                    sleep_time = 5
-                    splitted = command.split(" ")
-                    if len(splitted) > 1:
-                        try:
-                            sleep_time = int(splitted[1])
-                        except ValueError:
-                            pass
-                    sleep_time *= 60
-
-                    _stop_idling(idling_process)
-                    idling = False
-                    last_idle_time += time.time() - idle_start_time
-
-                    logging.info("Paused for {} seconds".format(sleep_time))
-                    logging.info("Press Ctrl+C to resume")
-                    try:
-                        time.sleep(sleep_time)
-                    except KeyboardInterrupt:
-                        pass
-                elif command == "n":
-                    command_skip = True
-                    command_keep = True
-                    break
-                elif command == "s":
-                    command_skip = True
-                    break
-                elif command == "q":
-                    command_quit = True
-                    break
+    paused_until = None
 
-        if idling:
-            _stop_idling(idling_process)
-            idling = False
-            last_idle_time += time.time() - idle_start_time
+    def resume(state):
+        if _resume_game(state):
+            _idle_environment["watch_idler"](loop, events, state, state["process"])
 
-        if command_quit:
-            break
+    def handle_command(command):
+        nonlocal paused_until
 
-        if not command_skip:
-            if erroneous_state:
-                logging.warning("Stopped idling game because of continuous errors")
-                command_keep = True
-            elif remaining_card_drops:
-                logging.warning("Stopped idling game because drop timeout was reached")
+        logging.debug('Got command: "%s"', command)
+        if command.startswith("p"):
+            pause_time = 5
+            splitted = command.split(" ")
+            if len(splitted) > 1:
+                try:
+                    pause_time = int(splitted[1])
+                except ValueError:
+                    pass
+            pause_time *= 60
+
+            for paused_state in active_games:
+                _pause_game(paused_state)
+            paused_until = _now() + pause_time
+
+            logging.info("Paused for %s seconds", pause_time)
+            return "paused for {} seconds".format(pause_time)
+        elif command == "r":
+            if paused_until is not None:
+                paused_until = _now()
+            return "resumed"
+        elif command in ("n", "s") or command.startswith(("n ", "s ")):
+            target_state = _find_command_target(command, active_games)
+            if not target_state:
+                return "no such game"
+            active_games.remove(target_state)
+            _finish_game(profile_name, idle_list, target_state, skipped=True,
+                         keep=command.startswith("n"), journal=journal)
+            return "ok"
+        elif command == "q":
+            return None
+        else:
+            for checked_state in active_games:
+                checked_state["next_check_time"] = _now()
+            return "rechecking"
+
+    def handle_ready(state, process, timed_out):
+        if state not in active_games or state["process"] is not process:
+            return
+
+        if _mark_game_ready(state, reported=not timed_out):
+            if timed_out:
+                logging.debug('Idler for "%s" didn\'t report readiness, assuming it is idling',
+                              state["name"])
             else:
-                logging.info('Successfully finished idling "{0}", idling time: {1}'.
-                             format(game_name, timedelta(seconds=last_idle_time)))
+                logging.debug('Idler for "%s" is ready', state["name"])
+
+    def handle_exit(state, process):
+        # the process is already replaced if idling was stopped on purpose
+        if state not in active_games or state["process"] is not process:
+            return
+
+        state["process"] = None
+        _count_idle_time(state)
+        _increment("idler_failures_total", game=state["id"])
+
+        delay = _get_idler_restart_delay(state)
+        state["idler_failures"] += 1
+        logging.warning('Idler for "%s" exited unexpectedly with code %s, '
+                        'restarting it in %s seconds', state["name"], process.returncode, delay)
+        loop.call_later(delay, _post_event, loop, events, ("restart", state, None))
+
+    def handle_restart(state):
+        if state not in active_games or state["process"] is not None:
+            return
+        # paused and suspended games are resumed after the next check
+        if paused_until is not None or \
+                (erroneous_state and
+                 first_time_error_occurred + _settings["error_suspend_timeout"] <= _now()):
+            return
+
+        resume(state)
+
+    journal = None
+    try:
+        if journal_filename:
+            journal = _open_journal(journal_filename, idle_list, source_list, active_games)
+
+        for state in active_games:
+            resume(state)
+
+        while True:
+            if paused_until is None:
+                active_ids = [state["id"] for state in active_games]
+                for game_id in idle_list:
+                    if len(active_games) >= slots:
+                        break
+                    if game_id not in active_ids:
+                        active_games.append(await loop.run_in_executor(
+                            None, _new_idle_state, game_id, idler_args))
+                        active_games[-1]["drop_intervals"] = \
+                            game_drop_intervals.setdefault(game_id, [])
+                        active_ids.append(game_id)
+                        _write_journal_entry(journal, "started",
+                                             state=_get_state_snapshot(active_games[-1]))
+
+            if not active_games:
+                break
 
-        if command_keep:
-            logging.info('Moving game "{0}" ({1}) to the end of idle list'.
-                         format(game_name, game_id))
-        else:
-            logging.info('Removing game "{0}" ({1}) from idle list'.
-                         format(game_name, game_id))
-        idle_list.pop(index)
-        index -= 1
+            state = min(active_games, key=itemgetter("next_check_time"))
+            wake_up_time = paused_until if paused_until is not None else state["next_check_time"]
 
-        if command_keep:
-            idle_list.append(game_id)
+            timeout = wake_up_time - _now()
+            if timeout > 0:
+                logging.info("Gonna sleep for %s seconds", int(round(timeout)))
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout)
+                except asyncio.TimeoutError:
+                    event = None
+
+                if event is not None:
+                    if event[0] == "exited":
+                        handle_exit(event[1], event[2])
+                        continue
+                    if event[0] in ("ready", "ready_timeout"):
+                        handle_ready(event[1], event[2], event[0] == "ready_timeout")
+                        continue
+                    if event[0] == "restart":
+                        handle_restart(event[1])
+                        continue
+
+                    command, reply = event[1], event[2]
+                    result = handle_command(command)
+                    if reply is not None and not reply.done():
+                        reply.set_result(result or "quitting")
+                    if result is None:
+                        break
+                    continue
+
+            if paused_until is not None:
+                paused_until = None
+                logging.info("Resumed")
+                for paused_state in active_games:
+                    paused_state["next_check_time"] = _now()
+                continue
+
+            # counters of several games are got from badges pages all at once,
+            # so all the games are checked together
+            checked_states = [state]
+            if len(active_games) > 1 and _settings["batch_drop_checks"]:
+                checked_states = list(active_games)
+
+            throttle_delay = 0
+            checked = False
+            try:
+                if len(checked_states) > 1:
+                    card_drops = await loop.run_in_executor(
+                        None, _idle_environment["get_games_card_drops"],
+                        [checked_state["id"] for checked_state in checked_states],
+                        profile_name, session)
+                    for checked_state in checked_states:
+                        checked_state["remaining_card_drops"] = card_drops[checked_state["id"]]
+                else:
+                    state["remaining_card_drops"] = await loop.run_in_executor(
+                        None, _idle_environment["get_card_drops"], state["id"], profile_name,
+                        session)
+                _increment("drop_checks_total", len(checked_states))
+                checked = True
+
+                for checked_state in checked_states:
+                    checked_state["erroneous_time_multiplier"] = 1
+                if erroneous_state:
+                    erroneous_state = False
+                    logging.info("Recovered from erroneous state")
+            except TooManyRequestsException as e:
+                # being throttled isn't an error, idling goes on
+                logging.warning("%s, next check in at least %s seconds", e, int(e.retry_after))
+                throttle_delay = e.retry_after
+            except Exception as e:
+                logging.warning("Exception on getting remaining card drops: %s", e)
+                if not erroneous_state:
+                    erroneous_state = True
+                    first_time_error_occurred = _now()
+                elif first_time_error_occurred + _settings["error_quit_timeout"] <= _now():
+                    logging.warning("In erroneous state for too long, quiting")
+                    break
 
-        logging.info("Games left {0}".format(len(idle_list)))
+            for state in checked_states:
+                # a game may have been removed by a command while it was checked
+                if state not in active_games:
+                    continue
+
+                # idling is suspended if errors persist for a while
+                idling_suspended = (erroneous_state and
+                                    first_time_error_occurred +
+                                    _settings["error_suspend_timeout"] <= _now())
+                if idling_suspended:
+                    for suspended_state in active_games:
+                        _pause_game(suspended_state)
+
+                dropped = False
+                remaining_card_drops = state["remaining_card_drops"]
+                if remaining_card_drops < state["last_remaining_card_drops"]:
+                    idle_time = _get_idle_time(state)
+                    if state["last_remaining_card_drops"] != 1000:
+                        dropped = True
+                        logging.info('Card was dropped for "%s"', state["name"])
+                        _increment("card_drops_total")
+                        _record_drop_interval(profile_name, state, drop_history,
+                                              idle_time - state["last_drop_idle_time"])
+                    state["last_remaining_card_drops"] = remaining_card_drops
+                    # the drop came some time after the previous check, so the drop timeout
+                    # is counted from then and doesn't depend on how often drops are checked
+                    state["last_drop_time"] = state["last_check_time"]
+                    state["last_drop_idle_time"] = idle_time
+
+                    logging.info('Card drops remaining for "%s": %s',
+                                 state["name"], remaining_card_drops)
+
+                if checked:
+                    state["last_check_time"] = _now()
+
+                if not remaining_card_drops or \
+                        state["last_drop_time"] + _get_drop_timeout(drop_history) <= _now():
+                    active_games.remove(state)
+                    _finish_game(profile_name, idle_list, state,
+                                 erroneous_state=erroneous_state,
+                                 throttled=bool(throttle_delay), journal=journal)
+                    continue
+
+                if not idling_suspended:
+                    resume(state)
+
+                check_delay = max(poll_policy(state, drop_history, erroneous_state),
+                                  throttle_delay)
+                state["next_check_time"] = _now() + check_delay
+
+                _write_journal_entry(journal, "dropped" if dropped else "checked",
+                                     state=_get_state_snapshot(state))
+
+            if _settings["prometheus_textfile"]:
+                _write_prometheus_textfile(_settings["prometheus_textfile"])
+    finally:
+        prefetch_stopped.set()
+
+        for state in active_games:
+            _pause_game(state)
+
+        if journal is not None:
+            journal.close()
+
+        if command_server is not None:
+            command_server.close()
+            os.remove(_settings["command_socket"])
 
     if idle_list:
         logging.info("Stopped idling list")
@@ -475,8 +2387,51 @@ def _idle(idle_list, profile_name, cookies):
     return idle_list
 
 
-def _start_idling(game_id):
-    if sys.platform.startswith("win32"):
+def _prime_playtime(idle_list, playtimes, slots=None):
+    if slots is None:
+        slots = _settings["priming_slots"]
+    threshold = _settings["priming_playtime"]
+
+    queue = [game_id for game_id in idle_list
+             if playtimes.get(game_id, threshold) < threshold]
+    if not queue:
+        return
+
+    logging.info("Priming playtime of %s game(s), %s at a time", len(queue), slots)
+
+    running = []
+    try:
+        while queue or running:
+            while queue and len(running) < slots:
+                game_id = queue.pop(0)
+                end_time = time.time() + (threshold - playtimes[game_id]) * 60 * 60
+                running.append((end_time, game_id, _start_idling(game_id)))
+
+            running.sort(key=itemgetter(0))
+            end_time, game_id, process = running[0]
+
+            sleep_time = int(round(end_time - time.time()))
+            if sleep_time > 0:
+                logging.info("Gonna sleep for %s seconds", sleep_time)
+                logging.info("Press Ctrl+C to stop priming and start idling for drops")
+                time.sleep(sleep_time)
+
+            _stop_idling(process)
+            running.pop(0)
+            logging.info("Finished priming game %s, games left %s",
+                         game_id, len(queue) + len(running))
+    except KeyboardInterrupt:
+        logging.info("Priming interrupted by user")
+    finally:
+        for end_time, game_id, process in running:
+            _stop_idling(process)
+
+
+def _get_idler_args(idler_command=None):
+    idler_command = idler_command or _settings["idler_command"]
+    if idler_command:
+        args = list(idler_command)
+    elif sys.platform.startswith("win32"):
         args = ["steam-idle.exe"]
     elif sys.platform.startswith("darwin"):
         args = ["./steam-idle"]
@@ -484,34 +2439,113 @@ def _start_idling(game_id):
         args = ["python", "steam-idle.py"]
     else:
         raise Exception("Unsupported platform: {}".format(sys.platform))
-    args.append(str(game_id))
 
-    return subprocess.Popen(args, start_new_session=True)
+    if _settings["idler_headless"]:
+        args.append("--headless")
+
+    return args
+
+
+def _spawn_idler_worker(idler_args):
+    # a worker does all the imports and loads the Steam API library
+    # and then waits for an app id on stdin
+    return subprocess.Popen(idler_args + ["--worker"], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, start_new_session=True,
+                            universal_newlines=True)
+
+
+def _fill_idler_pool(idler_args):
+    idler_pool = _idler_pools.setdefault(tuple(idler_args), [])
+    idler_pool[:] = [worker for worker in idler_pool if worker.poll() is None]
+
+    while len(idler_pool) < _settings["idler_pool_size"]:
+        idler_pool.append(_spawn_idler_worker(idler_args))
+
+    return idler_pool
+
+
+def _wait_for_idler(process):
+    try:
+        process.wait(_settings["idler_stop_timeout"])
+    except subprocess.TimeoutExpired:
+        logging.warning("Idler didn't stop in %s seconds, killing it",
+                        _settings["idler_stop_timeout"])
+        process.kill()
+        process.wait()
+
+
+def _shutdown_idler_pool():
+    for idler_pool in _idler_pools.values():
+        while idler_pool:
+            worker = idler_pool.pop()
+            # a worker exits by itself when its stdin is closed
+            worker.stdin.close()
+            _wait_for_idler(worker)
+
+
+def _start_idling(game_id, idler_args=None):
+    if idler_args is None:
+        idler_args = _get_idler_args()
+
+    if _settings["idler_pool_size"]:
+        idler_pool = _fill_idler_pool(idler_args)
+
+        worker = idler_pool.pop(0)
+        try:
+            worker.stdin.write("{}\n".format(game_id))
+            worker.stdin.close()
+        except (IOError, OSError) as e:
+            logging.warning("Couldn't hand game to idler worker: %s", e)
+            worker.kill()
+            worker = None
+
+        # a replacement starts warming up right away
+        _fill_idler_pool(idler_args)
+
+        if worker is not None:
+            return worker
+
+    return subprocess.Popen(idler_args + [str(game_id)], stdout=subprocess.PIPE,
+                            start_new_session=True, universal_newlines=True)
 
 
 def _stop_idling(idling_process):
     idling_process.terminate()
-    idling_process.wait()
 
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:  # priming doesn't run on an event loop
+        _wait_for_idler(idling_process)
+    else:
+        # the idle loop goes on while the idler exits, asyncio.run() waits for it at the end
+        loop.run_in_executor(None, _wait_for_idler, idling_process)
 
-def gather_badges_info(blacklist=None, whitelist=None):
+
+def iter_badges_info(blacklist=None, whitelist=None):
     auth_data = _get_auth_data()
-    cookies = _get_cookies(auth_data)
+    session = _get_session(auth_data)
 
-    return _gather_badges_info(auth_data["profile_name"], cookies,
-                               blacklist=blacklist, whitelist=whitelist)
+    return _iter_badges_info(auth_data["profile_name"], session,
+                             blacklist=blacklist, whitelist=whitelist)
 
 
-def get_game_remaining_card_drops(game_id, profile_name, cookies):
-    page = _get_badge_page(game_id, profile_name, cookies)
+def gather_badges_info(blacklist=None, whitelist=None):
+    return list(iter_badges_info(blacklist=blacklist, whitelist=whitelist))
 
-    if not page:
-        raise Exception("Error getting badge page")
 
-    if not _check_authorization(page):
-        raise NotAuthorizedException("Not authorized")
+def get_game_remaining_card_drops(game_id, profile_name, session):
+    if _settings["badge_page_probe"]:
+        authorized, card_drops_remaining = _probe_badge_page(game_id, profile_name, session)
+    else:
+        page_text = _get_badge_page(game_id, profile_name, session)
 
-    card_drops_remaining = _parse_remaining_card_drops(page)
+        if not page_text:
+            raise Exception("Error getting badge page")
+
+        authorized, card_drops_remaining = _parse_badge_page(page_text)
+
+    if not authorized:
+        raise NotAuthorizedException("Not authorized")
 
     if card_drops_remaining is None:
         raise Exception("Error getting remaining card drops info")
@@ -519,28 +2553,104 @@ def get_game_remaining_card_drops(game_id, profile_name, cookies):
     return card_drops_remaining
 
 
-def process_and_save_badges_info(filename):
-    badges = gather_badges_info()
+def get_games_remaining_card_drops(game_ids, profile_name, session):
+    card_drops = _get_badges_pages_card_drops(game_ids, profile_name, session)
 
-    with open(filename, "w") as f:
-        json.dump(badges, f, indent=4)
+    # games which moved to other pages are checked one by one
+    for game_id in game_ids:
+        if game_id not in card_drops:
+            logging.debug("Game %s not found on badges pages", game_id)
+            card_drops[game_id] = get_game_remaining_card_drops(game_id, profile_name, session)
+
+    return card_drops
+
+
+# the clock, the idlers and the drop source of the idle engine,
+# simulate.py replaces them to run it on virtual time
+_idle_environment = {
+    "time": time.time,
+    "start_idler": _start_idling,
+    "stop_idler": _stop_idling,
+    "watch_idler": _watch_idling_process,
+    "get_card_drops": get_game_remaining_card_drops,
+    "get_games_card_drops": get_games_remaining_card_drops,
+}
+
+
+def process_and_save_badges_info(filename):
+    _save_badges_info(iter_badges_info(), filename)
 
     logging.info("Saved")
 
 
+def store_badges_info(blacklist=None, whitelist=None):
+    auth_data = _get_auth_data()
+    session = _get_session(auth_data)
+
+    count = _store_badges_info(auth_data["profile_name"], _iter_badges_info(
+        auth_data["profile_name"], session, blacklist=blacklist, whitelist=whitelist),
+        replace=True)
+
+    logging.info("Stored %s badge(s)", count)
+
+
+def _refresh_stored_badges_info(profile_name, session, diff_filename=None):
+    previous_badges = _load_stored_badges_info(profile_name)
+    if not previous_badges:
+        count = _store_badges_info(profile_name, _iter_badges_info(profile_name, session),
+                                   replace=True)
+        logging.info("Stored %s badge(s)", count)
+        return None
+
+    badges = _refresh_badges_info(previous_badges, profile_name, session)
+
+    diff = _diff_badges_info(previous_badges, badges)
+    logging.info("Badges: %s new, %s removed, %s with changed card drops, %s ready",
+                 len(diff["new"]), len(diff["removed"]),
+                 len(diff["card_drops_remaining_changed"]), len(diff["badge_ready"]))
+
+    # only the rows that actually changed are written
+    previous = dict((_get_badge_key(badge_info), badge_info) for badge_info in previous_badges)
+    changed_badges = [badge_info for badge_info in badges
+                      if previous.get(_get_badge_key(badge_info)) != badge_info]
+    removed_keys = [(data["id"], data["title"]) for data in diff["removed"]]
+    _store_badges_info(profile_name, changed_badges, removed_keys=removed_keys)
+
+    if diff_filename:
+        with open(diff_filename, "w") as f:
+            json.dump(diff, f, indent=4)
+
+    logging.info("Stored %s changed badge(s)", len(changed_badges))
+
+    return diff
+
+
+def refresh_badges_info(diff_filename=None):
+    auth_data = _get_auth_data()
+    session = _get_session(auth_data)
+
+    return _refresh_stored_badges_info(auth_data["profile_name"], session, diff_filename)
+
+
 def generate_idle_list(
         filename=None, output_file_name=None, blacklist=None,
-        whitelist=None, filters=None, sort=None):
+        whitelist=None, filters=None, sort=None, stored=False):
     if filename:
-        with open(filename) as f:
-            badges_data = json.load(f)
+        badges_data = _load_badges_info(filename)
+        _seed_game_names(badges_data)
+
+        idle_list = _generate_idle_list(
+            badges_data, blacklist=blacklist, whitelist=whitelist,
+            filters=filters, sort=sort
+        )
     else:
-        badges_data = gather_badges_info()
+        if not stored:
+            store_badges_info()
 
-    idle_list = _generate_idle_list(
-        badges_data, blacklist=blacklist, whitelist=whitelist,
-        filters=filters, sort=sort
-    )
+        idle_list = _query_idle_list(
+            _get_auth_data()["profile_name"], blacklist=blacklist, whitelist=whitelist,
+            filters=filters, sort=sort
+        )
 
     if output_file_name:
         _write_id_list_to_file(idle_list, output_file_name)
@@ -550,20 +2660,142 @@ def generate_idle_list(
 
 def idle_from_file(filename):
     auth_data = _get_auth_data()
-    cookies = _get_cookies(auth_data)
+    session = _get_session(auth_data)
 
     idle_list = _read_id_list_from_file(filename)
 
-    idle_list = _idle(idle_list, auth_data["profile_name"], cookies)
+    try:
+        if _settings["priming_slots"]:
+            badges = _gather_badges_info(auth_data["profile_name"], session)
+            playtimes = dict((badge_info.id, badge_info.playtime)
+                             for badge_info in badges if badge_info.has_stats)
+            _prime_playtime(idle_list, playtimes)
+
+        idle_list = _idle(idle_list, auth_data["profile_name"], session)
+    finally:
+        _shutdown_idler_pool()
 
     _write_id_list_to_file(idle_list, filename)
+    _remove_journal(auth_data["profile_name"])
+
+
+def _load_account_idle_list(auth_data, session):
+    filename = auth_data["idle_list"]
+    if os.path.isfile(filename):
+        return _read_id_list_from_file(filename)
+
+    _refresh_stored_badges_info(auth_data["profile_name"], session)
+    idle_list = _query_idle_list(auth_data["profile_name"])
+    _write_id_list_to_file(idle_list, filename)
+
+    return idle_list
+
+
+async def _route_commands(events, accounts_events):
+    loop = asyncio.get_running_loop()
+    pending_replies = set()
+
+    async def send_reply(reply, replies):
+        results = await asyncio.gather(*replies)
+        if not reply.done():
+            reply.set_result("; ".join(results) or "no accounts")
+
+    while True:
+        event = await events.get()
+        command, reply = event[1], event[2]
+
+        # a command prefixed with an account name goes only to that account
+        name, _, account_command = command.partition(" ")
+        if name in accounts_events:
+            targets = [accounts_events[name]]
+            command = account_command
+        else:
+            targets = list(accounts_events.values())
+
+        replies = []
+        for target in targets:
+            replies.append(loop.create_future())
+            await target.put(("command", command, replies[-1]))
+
+        # an account still loading its idle list reads its commands later,
+        # which mustn't hold back the next commands to the others
+        if reply is not None:
+            task = loop.create_task(send_reply(reply, replies))
+            pending_replies.add(task)
+            task.add_done_callback(pending_replies.discard)
+
+
+async def _daemon_async(accounts_data):
+    loop = asyncio.get_running_loop()
+
+    events = asyncio.Queue()
+    accounts_events = {}
+
+    _start_stdin_reader(loop, events)
+    command_server = None
+    if _settings["command_socket"] and hasattr(asyncio, "start_unix_server"):
+        command_server = await _start_command_server(events, _settings["command_socket"])
+
+    logging.info(_COMMANDS_HELP)
+    logging.info("Prefix a command with an account name to send it only to that account")
+
+    async def run(auth_data):
+        name = auth_data["name"]
+        account_events = asyncio.Queue()
+        accounts_events[name] = account_events
+
+        idle_list = None
+        try:
+            session = _get_session(auth_data)
+            idle_list = await loop.run_in_executor(
+                None, _load_account_idle_list, auth_data, session)
+
+            logging.info('Idling %s game(s) of account "%s"', len(idle_list), name)
+            await _idle_async(idle_list, auth_data["profile_name"], session,
+                              events=account_events,
+                              idler_args=_get_idler_args(auth_data["idler_command"]))
+        except Exception as e:
+            logging.warning('Stopped idling account "%s" because of exception: %s', name, e)
+        finally:
+            del accounts_events[name]
+            while not account_events.empty():
+                event = account_events.get_nowait()
+                if event[0] == "command" and event[2] is not None and not event[2].done():
+                    event[2].set_result("finished")
+
+            if idle_list is not None:
+                _write_id_list_to_file(idle_list, auth_data["idle_list"])
+                _remove_journal(auth_data["profile_name"])
+
+    router = asyncio.ensure_future(_route_commands(events, accounts_events))
+    try:
+        await asyncio.gather(*[run(auth_data) for auth_data in accounts_data])
+    finally:
+        router.cancel()
+
+        if command_server is not None:
+            command_server.close()
+            os.remove(_settings["command_socket"])
+
+
+def daemon_mode(filename="config.json"):
+    accounts_data = _get_accounts_data(filename)
+    logging.info("Starting daemon for %s account(s)", len(accounts_data))
+
+    try:
+        asyncio.run(_daemon_async(accounts_data))
+    except KeyboardInterrupt:
+        logging.info("Interrupted by user")
+    finally:
+        _shutdown_idler_pool()
 
 
 # TODO: rewrite
 def automatic_mode():
     idle_list_filename = "idle_list.txt"
     if not os.path.isfile(idle_list_filename):
-        generate_idle_list(output_file_name=idle_list_filename)
+        refresh_badges_info(BADGES_DIFF_FILENAME)
+        generate_idle_list(output_file_name=idle_list_filename, stored=True)
 
     idle_from_file(idle_list_filename)
 
@@ -571,7 +2803,25 @@ def automatic_mode():
 def main(argv):
     _init()
 
-    automatic_mode()
+    mode = daemon_mode if "--daemon" in argv[1:] else automatic_mode
+
+    if not _settings["profile_directory"]:
+        mode()
+        return
+
+    # only the main thread is profiled, requests run in executor threads aren't
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        mode()
+    finally:
+        profiler.disable()
+
+        if not os.path.isdir(_settings["profile_directory"]):
+            os.makedirs(_settings["profile_directory"])
+        profiler.dump_stats(os.path.join(
+            _settings["profile_directory"],
+            "idle_master-{0}.prof".format(time.strftime("%Y%m%d-%H%M%S"))))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,391 @@
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import random
+import selectors
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import idlemaster
+
+
+PROFILE_NAME = "76561197960287930"
+
+BADGES_PER_PAGE = 150
+
+# simulated runs start at the same time, so logs and histories are the same on every run
+START_TIME = 1500000000.0
+
+TIMER_SLACK = 0.001
+
+DROP_DISTRIBUTIONS = {
+    "fixed": lambda rnd, mean: mean,
+    "uniform": lambda rnd, mean: rnd.uniform(0.5 * mean, 1.5 * mean),
+    "exponential": lambda rnd, mean: rnd.expovariate(1.0 / mean),
+}
+
+
+class _VirtualClockSelector(selectors.DefaultSelector):
+    def __init__(self, start_time):
+        super(_VirtualClockSelector, self).__init__()
+        self.time = start_time
+
+    def select(self, timeout=None):
+        # nothing happens between events of a simulation,
+        # so instead of waiting the clock jumps to the next timer
+        ready = super(_VirtualClockSelector, self).select(0)
+        if not ready:
+            if timeout is None:
+                raise Exception("Simulation is stuck: there is nothing to wait for")
+            # the loop runs timers due before its time plus the clock resolution,
+            # which is lost in float rounding at these magnitudes, so the clock goes a bit past
+            self.time += timeout + TIMER_SLACK
+
+        return ready
+
+
+class _VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, start_time):
+        self.virtual_clock = _VirtualClockSelector(start_time)
+        super(_VirtualClockEventLoop, self).__init__(self.virtual_clock)
+
+    def time(self):
+        return self.virtual_clock.time
+
+
+class _ImmediateExecutor(ThreadPoolExecutor):
+    # blocking calls of the engine are done right away, so no virtual time passes
+    # while they run and their order doesn't depend on threads
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+class _SimulatedIdler(object):
+    def __init__(self, game):
+        self.game = game
+        self.returncode = None
+
+
+def _generate_account(options):
+    rnd = random.Random(options.seed)
+    distribution = DROP_DISTRIBUTIONS[options.drop_distribution]
+
+    games = []
+    for i in range(options.games):
+        # some games drop slower than others
+        mean_interval = options.drop_interval * rnd.lognormvariate(0, options.drop_interval_spread)
+        card_drops = rnd.randint(options.min_drops, options.max_drops)
+
+        # drops come after the game was idled for these many seconds in total,
+        # drops of stuck games stop coming at some point
+        drop_idle_times = []
+        idle_time = 0
+        stuck_after = rnd.randrange(card_drops) if rnd.random() < options.stuck_rate else None
+        for n in range(card_drops):
+            if n == stuck_after:
+                idle_time = float("inf")
+            else:
+                idle_time += distribution(rnd, mean_interval)
+            drop_idle_times.append(idle_time)
+
+        games.append({
+            "id": 10 * (i + 1),
+            "title": "Game {0}".format(i + 1),
+            "page": i // BADGES_PER_PAGE + 1,
+            "drop_idle_times": drop_idle_times,
+            "idle_time": 0,
+            "idling_since": None,
+        })
+
+    return games
+
+
+def _get_game_idle_time(game, now):
+    idle_time = game["idle_time"]
+    if game["idling_since"] is not None:
+        idle_time += now - game["idling_since"]
+
+    return idle_time
+
+
+def _get_remaining_card_drops(game, now):
+    drop_idle_times = game["drop_idle_times"]
+    return len(drop_idle_times) - bisect.bisect_right(drop_idle_times,
+                                                      _get_game_idle_time(game, now))
+
+
+def _create_environment(account, loop, options, stats):
+    rnd = random.Random(options.seed)
+    games_by_id = dict((game["id"], game) for game in account)
+    outages = [(START_TIME + start * 60 * 60, START_TIME + (start + duration) * 60 * 60)
+               for start, duration in options.outage]
+
+    def start_idler(game_id, idler_args=None):
+        stats["idler_starts"] += 1
+        return _SimulatedIdler(games_by_id[game_id])
+
+    def stop_idler(process, returncode=0):
+        game = process.game
+        if game["idling_since"] is not None:
+            game["idle_time"] += loop.time() - game["idling_since"]
+            game["idling_since"] = None
+        process.returncode = returncode
+
+    def watch_idler(loop, events, state, process):
+        def report_ready():
+            if process.returncode is None:
+                process.game["idling_since"] = loop.time()
+                events.put_nowait(("ready", state, process))
+
+        def crash():
+            if process.returncode is None:
+                stats["idler_crashes"] += 1
+                stop_idler(process, 1)
+                events.put_nowait(("exited", state, process))
+
+        loop.call_later(options.idler_start_delay, report_ready)
+        if options.idler_crash_rate:
+            loop.call_later(rnd.expovariate(options.idler_crash_rate / 3600.0), crash)
+
+    def request(pages=1):
+        stats["requests"] += pages
+
+        now = loop.time()
+        if any(start <= now < end for start, end in outages):
+            stats["errors"] += pages
+            raise Exception("Simulated outage")
+
+        roll = rnd.random()
+        if roll < options.throttle_rate:
+            stats["throttled"] += pages
+            raise idlemaster.TooManyRequestsException("Too many requests", 60)
+        if roll < options.throttle_rate + options.error_rate:
+            stats["errors"] += pages
+            raise Exception("Simulated error")
+
+    def get_card_drops(game_id, profile_name, session):
+        request()
+        return _get_remaining_card_drops(games_by_id[game_id], loop.time())
+
+    def get_games_card_drops(game_ids, profile_name, session):
+        # counters of all the games on a badges page come with one request
+        request(len(set(games_by_id[game_id]["page"] for game_id in game_ids)))
+        return dict((game_id, _get_remaining_card_drops(games_by_id[game_id], loop.time()))
+                    for game_id in game_ids)
+
+    return {
+        "time": loop.time,
+        "start_idler": start_idler,
+        "stop_idler": stop_idler,
+        "watch_idler": watch_idler,
+        "get_card_drops": get_card_drops,
+        "get_games_card_drops": get_games_card_drops,
+    }
+
+
+def _get_idle_history():
+    with idlemaster._db_lock:
+        rows = idlemaster._get_db().execute(
+            "SELECT result, COUNT(*), SUM(idle_time), SUM(dead_time) FROM idle_history" +
+            " WHERE profile = ? GROUP BY result", (PROFILE_NAME,)).fetchall()
+
+    return dict((row[0], row[1:]) for row in rows)
+
+
+def run_simulation(options):
+    idlemaster._settings.update({
+        # nothing is kept between runs
+        "state_db": ":memory:",
+        "journal_file": None,
+        "metrics_file": None,
+        "prometheus_textfile": None,
+        "command_socket": None,
+        "idle_slots": options.slots,
+        "poll_policy": options.poll_policy,
+    })
+    idlemaster._settings.update(options.setting)
+    idlemaster._metrics.clear()
+
+    account = _generate_account(options)
+    for game in account:
+        idlemaster._set_cached_value(idlemaster.GAME_NAMES_TABLE, game["id"], game["title"])
+    idle_list = [game["id"] for game in account]
+
+    loop = _VirtualClockEventLoop(START_TIME)
+    executor = _ImmediateExecutor(max_workers=1)
+    loop.set_default_executor(executor)
+
+    stats = {"requests": 0, "errors": 0, "throttled": 0, "idler_starts": 0, "idler_crashes": 0}
+    real_environment = dict(idlemaster._idle_environment)
+    idlemaster._idle_environment.update(_create_environment(account, loop, options, stats))
+
+    # log records are stamped with the virtual time
+    record_factory = logging.getLogRecordFactory()
+
+    def create_record(*args, **kwargs):
+        record = record_factory(*args, **kwargs)
+        record.created = loop.time()
+        return record
+
+    async def simulate():
+        events = asyncio.Queue()
+
+        for hours, command in options.command:
+            loop.call_at(START_TIME + hours * 60 * 60, events.put_nowait,
+                         ("command", command, None))
+        if options.hours is not None:
+            loop.call_at(START_TIME + options.hours * 60 * 60, events.put_nowait,
+                         ("command", "q", None))
+
+        return await idlemaster._idle_async(idle_list, PROFILE_NAME, None, events=events)
+
+    logging.setLogRecordFactory(create_record)
+    start_time = time.time()
+    try:
+        left_games = loop.run_until_complete(simulate())
+    finally:
+        logging.setLogRecordFactory(record_factory)
+        idlemaster._idle_environment.update(real_environment)
+        loop.close()
+        executor.shutdown()
+    elapsed = time.time() - start_time
+
+    simulated_hours = (loop.time() - START_TIME) / 60 / 60
+    card_drops = sum(len(game["drop_idle_times"]) - _get_remaining_card_drops(game, loop.time())
+                     for game in account)
+    history = _get_idle_history()
+    idle_seconds = sum(entry[1] for entry in history.values())
+    dead_seconds = sum(entry[2] for entry in history.values())
+
+    report = {
+        "seconds": round(elapsed, 3),
+        "simulated_hours": round(simulated_hours, 2),
+        "games": len(account),
+        "games_left": len(left_games),
+        "card_drops": card_drops,
+        "card_drops_total": sum(len(game["drop_idle_times"]) for game in account),
+        "cards_per_hour": round(card_drops / simulated_hours, 3) if simulated_hours else None,
+        "requests": stats["requests"],
+        "requests_per_card": round(stats["requests"] / card_drops, 2) if card_drops else None,
+        "errors": stats["errors"],
+        "throttled": stats["throttled"],
+        "idler_starts": stats["idler_starts"],
+        "idler_crashes": stats["idler_crashes"],
+        "idle_hours": round(idle_seconds / 60 / 60, 2),
+        "dead_hours": round(dead_seconds / 60 / 60, 2),
+        "results": dict((result, entry[0]) for result, entry in sorted(history.items())),
+    }
+
+    idlemaster._close_db()
+
+    logging.warning(json.dumps(report))
+
+    return report
+
+
+def _parse_setting(text):
+    key, _, value = text.partition("=")
+    if key not in idlemaster.DEFAULT_SETTINGS:
+        raise argparse.ArgumentTypeError('unknown setting "{0}"'.format(key))
+
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def _parse_timed_command(text):
+    hours, _, command = text.partition(":")
+    try:
+        return float(hours), command
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{0}" is not HOURS:COMMAND'.format(text))
+
+
+def _parse_outage(text):
+    try:
+        start, duration = text.split(":")
+        return float(start), float(duration)
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{0}" is not START:DURATION'.format(text))
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Simulate idling of an account on a virtual clock")
+    parser.add_argument("--games", type=int, default=20,
+                        help="number of games with card drops (default: %(default)s)")
+    parser.add_argument("--min-drops", type=int, default=1,
+                        help="least card drops of a game (default: %(default)s)")
+    parser.add_argument("--max-drops", type=int, default=4,
+                        help="most card drops of a game (default: %(default)s)")
+    parser.add_argument("--drop-interval", type=float, default=30 * 60,
+                        help="mean idling seconds between drops (default: %(default)s)")
+    parser.add_argument("--drop-interval-spread", type=float, default=0.3,
+                        help="sigma of the log-normal spread of mean drop intervals "
+                             "between games (default: %(default)s)")
+    parser.add_argument("--drop-distribution", choices=sorted(DROP_DISTRIBUTIONS),
+                        default="exponential",
+                        help="distribution of drop intervals of a game (default: %(default)s)")
+    parser.add_argument("--stuck-rate", type=float, default=0.05,
+                        help="fraction of games whose drops stop coming (default: %(default)s)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of drop checks that fail (default: %(default)s)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of drop checks that are throttled (default: %(default)s)")
+    parser.add_argument("--outage", type=_parse_outage, action="append", default=[],
+                        metavar="START:DURATION",
+                        help="hours since the start when all drop checks fail and "
+                             "how many hours that lasts, may be repeated")
+    parser.add_argument("--idler-start-delay", type=float, default=5,
+                        help="seconds an idler takes to start idling (default: %(default)s)")
+    parser.add_argument("--idler-crash-rate", type=float, default=0.0,
+                        help="idler crashes per hour (default: %(default)s)")
+    parser.add_argument("--slots", type=int, default=1,
+                        help="number of games idled at a time (default: %(default)s)")
+    parser.add_argument("--poll-policy", choices=sorted(idlemaster._poll_policies),
+                        default=idlemaster.DEFAULT_SETTINGS["poll_policy"],
+                        help="poll policy (default: %(default)s)")
+    parser.add_argument("--setting", type=_parse_setting, action="append", default=[],
+                        metavar="KEY=VALUE",
+                        help="setting of idle master, the value is parsed as JSON, "
+                             "may be repeated")
+    parser.add_argument("--command", type=_parse_timed_command, action="append", default=[],
+                        metavar="HOURS:COMMAND",
+                        help="console command sent after these many hours, may be repeated")
+    parser.add_argument("--hours", type=float,
+                        help="hours after which idling is stopped (default: until the idle "
+                             "list is finished)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="random seed (default: %(default)s)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="log what idle master does")
+    parser.add_argument("--output", help="file to write the JSON report to")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = _parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S",
+                        level=logging.INFO if options.verbose else logging.WARNING)
+
+    report = run_simulation(options)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
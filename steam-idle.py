@@ -3,16 +3,11 @@ import os
 import sys
 import platform
 import io
-from PIL import Image, ImageTk
-from ctypes import CDLL
-try: #Python 2
-    from urllib2 import urlopen
-except ImportError: # Python 3
-    from urllib.request import urlopen
-try:
-    import Tkinter as tk
-except ImportError:
-    import tkinter as tk
+import signal
+import time
+from ctypes import CDLL, c_bool
+
+HEADER_CACHE_DIRECTORY = 'header_cache'
 
 def get_steam_api():
     if sys.platform.startswith('win32'):
@@ -33,18 +28,56 @@ def get_steam_api():
     else:
         print('Operating system not supported')
         sys.exit()
-        
+
+    # SteamAPI_Init returns a C bool, which ctypes would read as an int
+    steam_api.SteamAPI_Init.restype = c_bool
     return steam_api
 
+
+def import_gui_modules():
+    # the GUI dependencies are only loaded when the window is shown
+    from PIL import Image, ImageTk
+    try:
+        import Tkinter as tk
+    except ImportError:
+        import tkinter as tk
+
+    return Image, ImageTk, tk
+
+
+def get_header_image(str_app_id):
+    filename = os.path.join(HEADER_CACHE_DIRECTORY, str_app_id + '.jpg')
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    try: #Python 2
+        from urllib2 import urlopen
+    except ImportError: # Python 3
+        from urllib.request import urlopen
+
+    url = "http://cdn.akamai.steamstatic.com/steam/apps/" + str_app_id + "/header_292x136.jpg"
+    image_bytes = urlopen(url).read()
+
+    try:
+        if not os.path.isdir(HEADER_CACHE_DIRECTORY):
+            os.makedirs(HEADER_CACHE_DIRECTORY)
+        with open(filename, 'wb') as f:
+            f.write(image_bytes)
+    except (IOError, OSError):
+        print("Couldn't cache header image")
+
+    return image_bytes
+
     
 def init_gui(str_app_id):
+    Image, ImageTk, tk = import_gui_modules()
+
     gui = tk.Tk()
     gui.title('App ' + str_app_id)
     gui.resizable(0,0)
     try:
-        url = "http://cdn.akamai.steamstatic.com/steam/apps/" + str_app_id + "/header_292x136.jpg"
-        image_bytes = urlopen(url).read()
-        data_stream = io.BytesIO(image_bytes)
+        data_stream = io.BytesIO(get_header_image(str_app_id))
         pil_image = Image.open(data_stream)
         tk_image = ImageTk.PhotoImage(pil_image)
         label = tk.Label(gui, image=tk_image)
@@ -54,21 +87,58 @@ def init_gui(str_app_id):
         
     label.pack()
     return gui
+
+
+def report_ready():
+    # idle master counts idle time from this line
+    print('ready')
+    sys.stdout.flush()
+
+
+def wait_for_termination():
+    # a headless idler runs until idle master terminates it
+    if hasattr(signal, 'pause'):
+        while True:
+            signal.pause()
+    else:
+        while True:
+            time.sleep(60 * 60)
     
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
+    args = sys.argv[1:]
+    headless = '--headless' in args
+    if headless:
+        args.remove('--headless')
+
+    if len(args) != 1:
         print("Wrong number of arguments")
         sys.exit()
         
-    str_app_id = sys.argv[1]
+    if args[0] == '--worker':
+        # warm worker: everything is loaded before the app id arrives on stdin
+        steam_api = get_steam_api()
+        if not headless:
+            import_gui_modules()
+        str_app_id = sys.stdin.readline().strip()
+        if not str_app_id:
+            sys.exit()
+    else:
+        steam_api = None
+        str_app_id = args[0]
     
     os.environ["SteamAppId"] = str_app_id
     try:
-        get_steam_api().SteamAPI_Init()
+        initialized = (steam_api or get_steam_api()).SteamAPI_Init()
     except:
+        initialized = False
+    if not initialized:
         print("Couldn't initialize Steam API")
-        sys.exit()
-        
-    gui = init_gui(str_app_id)
-    gui.mainloop()
-    
\ No newline at end of file
+        sys.exit(1)
+
+    if headless:
+        report_ready()
+        wait_for_termination()
+    else:
+        gui = init_gui(str_app_id)
+        report_ready()
+        gui.mainloop()